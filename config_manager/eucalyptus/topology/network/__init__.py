@@ -15,6 +15,7 @@
 # limitations under the License.
 from config_manager.baseconfig import BaseConfig
 import socket
+import struct
 import copy
 
 
@@ -115,17 +116,7 @@ class Network(BaseConfig):
 
     def is_ip_in_range(self, ip, range_start, range_end):
         self.validate_ip_strings([ip, range_start, range_end])
-        if ip == range_start or ip == range_end:
-            return True
-        ip_octs = ip.split('.')
-        rangestart_octs = range_start.split('.')
-        rangeend_octs = range_end.split('.')
-        for x in xrange(0, len(rangestart_octs)):
-            if rangestart_octs[x] > ip_octs[x]:
-                return False
-            elif rangestart_octs[x] < ip_octs[x]:
-                for y in xrange(0, len(rangeend_octs)):
-                    if rangeend_octs[y] < ip_octs[y]:
-                        return False
-                return True
-        return False
+        # compare the addresses as numbers, octets compared as strings put "10.0.0.9" after "10.0.0.20"
+        ip, range_start, range_end = [struct.unpack('!I', socket.inet_aton(address))[0]
+                                      for address in (ip, range_start, range_end)]
+        return range_start <= ip <= range_end
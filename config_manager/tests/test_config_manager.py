@@ -1,5 +1,20 @@
 from config_manager.eucalyptus import Eucalyptus
+from config_manager.eucalyptus.topology.network import Network
 
 
 def test_init():
     Eucalyptus()
+
+
+def test_ip_ranges():
+    network = Network(public_ips=['10.111.1.5-10.111.1.20'], private_ips=[])
+    assert network.is_ip_in_range('10.111.1.9', '10.111.1.5', '10.111.1.20')
+    assert not network.is_ip_in_range('10.111.1.21', '10.111.1.5', '10.111.1.20')
+    network.add_public_ip_entry('10.111.1.30-10.111.1.40,10.111.1.50')
+    assert network.public_ips.value == ['10.111.1.5-10.111.1.20', '10.111.1.30-10.111.1.40', '10.111.1.50']
+    try:
+        network.add_public_ip_entry('10.111.1.9')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
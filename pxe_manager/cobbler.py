@@ -0,0 +1,179 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import xmlrpclib
+
+from time import time
+
+
+class SystemNotFoundException(Exception):
+    pass
+
+
+class CobblerClient(object):
+    def __init__(self, url, user, password):
+        """
+        Wrapper around the cobbler XML-RPC API that
+
+        * keeps one keep-alive HTTP connection per thread (xmlrpclib proxies reuse their connection but can't be
+          shared between threads)
+        * sends independent calls together in a single request with MultiCall
+        * logs in again and retries when the login token has expired
+
+        Anonymous calls can be made directly, ex: cobbler.get_systems(). Calls that take the login token as their
+        last argument go through call_authenticated(), which fills it in.
+
+        :param url: (string) URL of cobbler server
+        :param user: (string) cobbler user
+        :param password: (string) cobbler user's password
+        """
+        self.url = url
+        self.user = user
+        self.password = password
+        self.token = None
+        self.multicall_supported = True
+        self._local = threading.local()
+        self._login_lock = threading.Lock()
+        self.login()
+
+    @property
+    def proxy(self):
+        if not hasattr(self._local, 'proxy'):
+            self._local.proxy = xmlrpclib.ServerProxy(self.url)
+        return self._local.proxy
+
+    def login(self, expired_token=None):
+        """
+        Get a new login token. When several threads hit an expired token at the same time only the first one logs in.
+
+        :param expired_token: token that was rejected, None to always log in
+        """
+        with self._login_lock:
+            if expired_token is None or self.token == expired_token:
+                self.token = self.proxy.login(self.user, self.password)
+        return self.token
+
+    @staticmethod
+    def is_token_expired(fault):
+        return 'invalid token' in fault.faultString
+
+    def call(self, method, *args):
+        return getattr(self.proxy, method)(*args)
+
+    def call_authenticated(self, method, *args):
+        token = self.token
+        try:
+            return self.call(method, *(args + (token,)))
+        except xmlrpclib.Fault as e:
+            if not self.is_token_expired(e):
+                raise
+        return self.call(method, *(args + (self.login(expired_token=token),)))
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    def batch(self, calls, authenticated=False):
+        """
+        Run several independent calls in one request. Servers that don't register system.multicall get the calls
+        one after another over the same connection instead.
+
+        :param calls: list of (method, args) tuples
+        :param authenticated: append the login token to the arguments of every call
+        :return: list of the results, in the order of calls
+        """
+        token = self.token
+        try:
+            return self._batch(calls, token if authenticated else None)
+        except xmlrpclib.Fault as e:
+            if not (authenticated and self.is_token_expired(e)):
+                raise
+        return self._batch(calls, self.login(expired_token=token))
+
+    def _batch(self, calls, token):
+        if token is not None:
+            calls = [(method, tuple(args) + (token,)) for method, args in calls]
+        if self.multicall_supported and len(calls) > 1:
+            multicall = xmlrpclib.MultiCall(self.proxy)
+            for method, args in calls:
+                getattr(multicall, method)(*args)
+            try:
+                return list(multicall())
+            except xmlrpclib.Fault as e:
+                if 'system.multicall' not in e.faultString:
+                    raise
+                self.multicall_supported = False
+        return [self.call(method, *args) for method, args in calls]
+
+
+class CobblerSystemIndex(object):
+    def __init__(self, get_systems, max_age=300, interface='em1'):
+        """
+        In memory index of the cobbler systems by hostname, built from a single bulk listing instead of a
+        find_system/get_system round trip pair per host. The index is rebuilt when it is older than max_age, or when
+        a hostname isn't in it (a system may have been added to cobbler since the last listing).
+
+        :param get_systems: function returning the list of all cobbler system records, ex: cobbler.get_systems
+        :param max_age: (int) seconds before the index is rebuilt
+        :param interface: (string) default interface to return IPs for
+        """
+        self.get_systems = get_systems
+        self.max_age = max_age
+        self.interface = interface
+        self.systems = {}
+        self.built = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            self.systems = dict((system['hostname'], system) for system in self.get_systems())
+            self.built = time()
+
+    def invalidate(self):
+        self.built = 0
+
+    def get_system(self, hostname):
+        """
+        :param hostname: hostname of the system
+        :return: the cobbler system record
+        """
+        if time() - self.built > self.max_age or hostname not in self.systems:
+            self.refresh()
+        if hostname not in self.systems:
+            raise SystemNotFoundException(hostname)
+        return self.systems[hostname]
+
+    def get_system_name(self, hostname):
+        return self.get_system(hostname)['name']
+
+    def get_ip(self, hostname, interface=None):
+        return self.get_system(hostname)['interfaces'][interface or self.interface]['ip_address']
@@ -0,0 +1,89 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+from resource_manager.ranges import best_fit, int_to_ip, ip_to_int
+
+
+def find_runs(numbers):
+    """
+    :param numbers: sorted list of distinct integers
+    :return: list of the (first, last) pairs of the consecutive runs in numbers
+    """
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][1] == number - 1:
+            runs[-1] = (runs[-1][0], number)
+        else:
+            runs.append((number, number))
+    return runs
+
+
+def to_ranges(addresses):
+    """
+    Collapse a list of addresses into "first-last" ranges, the format config_manager's Network takes for its IP
+    entries, ex: ['10.111.1.1', '10.111.1.2', '10.111.1.3', '10.111.1.7'] -> ['10.111.1.1-10.111.1.3', '10.111.1.7']
+
+    :param addresses: list of IPv4 addresses
+    :return: list of ranges and single addresses, in address order
+    """
+    ranges = []
+    for first, last in find_runs(sorted(set(ip_to_int(address) for address in addresses))):
+        if first == last:
+            ranges.append(int_to_ip(first))
+        else:
+            ranges.append(int_to_ip(first) + '-' + int_to_ip(last))
+    return ranges
+
+
+class IPRangeAllocator(object):
+    def __init__(self, free_addresses):
+        """
+        Sorted map of the free space of an address pool, handing out contiguous blocks of addresses where possible.
+
+        :param free_addresses: list of the free IPv4 addresses of the pool
+        """
+        self.runs = find_runs(sorted(set(ip_to_int(address) for address in free_addresses)))
+
+    def allocate(self, count):
+        """
+        Pick count addresses from the free runs, see resource_manager.ranges.best_fit. The picked addresses are
+        removed from the free map.
+
+        :param count: how many addresses to pick
+        :return: list of the picked addresses in address order, shorter than count if the pool is too small
+        """
+        picked = []
+        for run, take in best_fit(self.runs, count):
+            picked.extend(range(run[0], run[0] + take))
+            self.runs.remove(run)
+            if run[0] + take <= run[1]:
+                self.runs.append((run[0] + take, run[1]))
+        self.runs.sort()
+        return [int_to_ip(number) for number in sorted(picked)]
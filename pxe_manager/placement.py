@@ -0,0 +1,97 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import random
+
+
+class RandomPlacement(object):
+    """
+    Order candidate hosts randomly, spreading reservations over the whole pool.
+    """
+    def rank(self, resources, tags=None):
+        """
+        :param resources: list of candidate host documents, each with a 'tags' dict
+        :param tags: dict of requested tags
+        :return: the candidates in order of preference
+        """
+        ranked = list(resources)
+        random.shuffle(ranked)
+        return ranked
+
+
+class BestFitPlacement(object):
+    def __init__(self, dimensions=('memory', 'cpucores', 'cpumhz'), tolerance=0.05):
+        """
+        Order candidate hosts by how tightly they fit a request, so small requests land on small hosts and the big
+        ones stay free for the requests that need them. The fit of a host is its spare capacity over the request on
+        each dimension, relative to the biggest candidate on that dimension, summed over the dimensions. Dimensions
+        that aren't requested count as a request for 0, so hosts that are bigger than needed in any way rank lower.
+        Hosts whose fit is within tolerance of each other (usually the same hardware model) are shuffled to spread
+        the load among them.
+
+        :param dimensions: numeric tags to fit on
+        :param tolerance: fraction of the maximum slack under which two hosts are considered an equal fit
+        """
+        self.dimensions = dimensions
+        self.tolerance = tolerance
+
+    def slack(self, resources, tags=None):
+        """
+        :param resources: list of candidate host documents, each with a 'tags' dict
+        :param tags: dict of requested tags
+        :return: list of the normalized spare capacity of each candidate, 0 is a perfect fit
+        """
+        tags = tags or {}
+        scores = [0.0] * len(resources)
+        for dimension in self.dimensions:
+            wanted = tags.get(dimension)
+            if not isinstance(wanted, (int, long, float)):
+                wanted = 0
+            values = [resource.get('tags', {}).get(dimension) for resource in resources]
+            # missing and non-numeric tags count as no capacity
+            values = [value if isinstance(value, (int, long, float)) else 0 for value in values]
+            biggest = max(values) if values else 0
+            if not biggest:
+                continue
+            for i, value in enumerate(values):
+                # memory is matched with a 10% fudge factor so spare capacity can be slightly negative
+                scores[i] += max(value - wanted, 0) / float(biggest)
+        return scores
+
+    def rank(self, resources, tags=None):
+        """
+        :param resources: list of candidate host documents, each with a 'tags' dict
+        :param tags: dict of requested tags
+        :return: the candidates in order of preference
+        """
+        scores = self.slack(resources, tags)
+        step = self.tolerance * len(self.dimensions)
+        keys = [(int(score / step) if step else score, random.random()) for score in scores]
+        return [resource for _, resource in sorted(zip(keys, resources), key=lambda pair: pair[0])]
@@ -30,23 +30,46 @@
 #
 # Author: Tony Beckham tony@eucalyptus.com
 #
+import copy
 import json
-import operator
+import Queue
 import random
 import socket
-import xmlrpclib
+import threading
 
-from time import sleep
-from paramiko import BadHostKeyException, AuthenticationException, SSHException, SSHClient, AutoAddPolicy
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+from paramiko import BadHostKeyException, AuthenticationException, SSHException
+
+from pxe_manager.cobbler import CobblerClient, CobblerSystemIndex
+from pxe_manager.ipalloc import IPRangeAllocator, to_ranges
+from pxe_manager.placement import BestFitPlacement
+from pxe_manager.ssh import SSHSessionManager, port_open
+from pxe_manager.tagindex import TagIndex
+from pxe_manager.timing import Timer
 
 
 class UnableToFullfillRequestException(Exception):
     pass
 
 
+class FreeResourcesException(Exception):
+    def __init__(self, failures):
+        """
+        :param failures: list of the bulk update results of the resources that could not be freed
+        """
+        self.failures = failures
+
+    def __str__(self):
+        return "Could not free: {0}".format(", ".join(
+            "{0} ({1})".format(failure.get('hostname') or failure.get('address') or failure.get('_id'),
+                               failure.get('_issues')) for failure in self.failures))
+
+
 class PxeManager(object):
     def __init__(self, cobbler_url, cobbler_user, cobbler_password, host_manager_client, public_ip_manager_client,
-                 private_ip_manager_client, ssh_user="root", ssh_password="foobar"):
+                 private_ip_manager_client, ssh_user="root", ssh_password="foobar", parallelism=1,
+                 boot_wait=120, placement=None, timing_sinks=None):
         """
 
         :param cobbler_url: (string) URL of cobbler server
@@ -57,14 +80,20 @@ class PxeManager(object):
         :param private_ip_manager_client: (object) ResourceManger object for private IPs
         :param ssh_user: (string) user to attempt ssh login to reserved host
         :param ssh_password: (string) password for user of reserved host
+        :param parallelism: (int) how many hosts of a reservation are provisioned at the same time
+        :param boot_wait: (int) seconds to let a host reboot after kickstarting it before checking on it
+        :param placement: (object) orders the candidate hosts of a reservation, see pxe_manager.placement.
+                          Defaults to BestFitPlacement
+        :param timing_sinks: (list) sinks receiving the timing events of each phase of a reservation, see
+                             pxe_manager.timing
         """
-        self.cobbler = xmlrpclib.Server(cobbler_url)
-        self.token = self.cobbler.login(cobbler_user, cobbler_password)
+        self.cobbler = CobblerClient(cobbler_url, cobbler_user, cobbler_password)
         self.host_manager = host_manager_client
         self.public_ip_manager = public_ip_manager_client
         self.private_ip_manager = private_ip_manager_client
         self.ssh_user = ssh_user
         self.ssh_password = ssh_password
+        self.ssh = SSHSessionManager(ssh_user, ssh_password)
         self.distro = {'centos': 'centos7-x86_64-raid0',
                        'rhel': 'rhel7-x86_64-raid0',
                        'centos6u7': 'centos6u7-x86_64-raid0',
@@ -75,8 +104,38 @@ class PxeManager(object):
         self.file_name = 'kickstart.check'
         self.public_ip_reservation = []
         self.private_ip_reservation = []
+        self.parallelism = parallelism
+        self.boot_wait = boot_wait
+        self.kickstart_times = {}
+        self.power_tasks = {}
+        self.systems = CobblerSystemIndex(lambda: self.cobbler.get_systems())
+        self.placement = placement or BestFitPlacement()
+        self.timer = Timer(timing_sinks)
+        # hostname -> job_id of the reservation it was claimed for, to tag timing events
+        self.host_jobs = {}
+
+    @property
+    def token(self):
+        return self.cobbler.token
+
+    def for_reservation(self):
+        """
+        Copy of this manager for making another reservation at the same time. The copy shares the cobbler client,
+        the SSH sessions, the system index and the timing sinks, which are all thread safe, but has its own
+        reservation lists and bookkeeping by host and cobbler task.
 
-    def make_host_reservation(self, owner, count, job_id, distro, tags=None):
+        :return: PxeManager
+        """
+        manager = copy.copy(self)
+        manager.host_reservation = []
+        manager.public_ip_reservation = []
+        manager.private_ip_reservation = []
+        manager.kickstart_times = {}
+        manager.power_tasks = {}
+        manager.host_jobs = {}
+        return manager
+
+    def make_host_reservation(self, owner, count, job_id, distro, tags=None, spares=0, use_ready=True):
         """
         Get machines from machine pool
         :param tags: Dict of tags that you want to use to filter resources
@@ -84,10 +143,111 @@ class PxeManager(object):
         :param count: how many machines to reserve
         :param job_id: unique identifier for the reservation
         :param distro: what OS to install (see the global dict "distro" for valid options)
+        :param spares: how many extra machines to kickstart up front. The first count machines that come up are kept
+                       and the others are released, so a failed kickstart doesn't cost another boot cycle. Fewer
+                       spares are used when there aren't enough free machines.
+        :param use_ready: take machines already kickstarted with distro from the warm pool (state "ready") first,
+                          see pxe_manager.warmpool
         :return:
         """
+        with self.timer.phase('host_reservation', job_id=job_id, count=count, spares=spares):
+            if use_ready:
+                with self.timer.phase('take_ready_hosts', job_id=job_id) as event:
+                    taken = self.take_ready_hosts(owner=owner, count=count, job_id=job_id, distro=distro, tags=tags)
+                    event['hosts'] = len(taken)
+                count -= len(taken)
+                if not count:
+                    print "Request fulfilled from the warm pool with hosts", self.host_reservation
+                    return
+            with self.timer.phase('provision', job_id=job_id):
+                kickstarted = self.reserve_and_provision_hosts(owner=owner, count=count, job_id=job_id, distro=distro,
+                                                               tags=tags, spares=spares)
+
+            print "The reservation is for hosts ", self.host_reservation
+            with self.timer.phase('wait_for_hosts', job_id=job_id):
+                kept = self.wait_for_hosts(kickstarted, replace=lambda: self.reserve_and_provision_hosts(
+                    owner=owner, count=1, job_id=job_id, distro=distro, tags=tags), needed=count)
+            print "The reservation is for hosts ", kept
+
+        print "Request fulfilled."
+        return
+
+    def reserve_and_provision_hosts(self, owner, count, job_id, distro, tags=None, spares=0):
+        """
+        Claim and kickstart count hosts, plus spares extra ones if there are enough free hosts, claiming replacements
+        for the ones that fail preflight checks. Replacements for spares are best effort, the reservation only fails
+        if fewer than count hosts could be kickstarted.
+
+        :return: list of the kickstarted hosts
+        """
+        try:
+            reserved_hosts = self.reserve_hosts(owner=owner, count=count + spares, job_id=job_id, tags=tags)
+        except UnableToFullfillRequestException:
+            if not spares:
+                raise
+            print "INFO: not enough free hosts for", spares, "spare(s), reserving without spares"
+            spares = 0
+            reserved_hosts = self.reserve_hosts(owner=owner, count=count, job_id=job_id, tags=tags)
+        kickstarted = []
+        while True:
+            failed_hosts = self.provision_hosts(reserved_hosts, distro)
+            kickstarted.extend(hostname for hostname in reserved_hosts if hostname not in failed_hosts)
+            missing = count + spares - len(kickstarted)
+            if not missing:
+                return kickstarted
+            print "INFO: reserving", missing, "replacement host(s)"
+            try:
+                reserved_hosts = self.reserve_hosts(owner=owner, count=missing, job_id=job_id, tags=tags)
+            except UnableToFullfillRequestException:
+                if len(kickstarted) < count:
+                    raise
+                print "INFO: no replacement for the failed spare(s), continuing with", len(kickstarted), "host(s)"
+                return kickstarted
+
+    def take_ready_hosts(self, owner, count, job_id, distro, tags=None):
+        """
+        Claim up to count hosts that were kickstarted with distro ahead of time and are waiting in the "ready"
+        state. They go straight to in_use without a kickstart, once their SSH port answers. Hosts that don't answer
+        are marked needs_repair and replaced by other ready hosts when there are some.
+
+        :return: list of the claimed hosts, possibly fewer than count
+        """
+        ready_machines = self.host_manager.query_resources(where={'state': 'ready', 'distro': distro}, fields=["tags"])
+        if tags:
+            ready_machines = self.filter_hosts_by_tags(ready_machines, tags)
+        candidates = [machine['hostname'] for machine in self.placement.rank(ready_machines, tags)]
+        claimed = []
+        while len(claimed) < count and candidates:
+            needed = count - len(claimed)
+            batch, candidates = candidates[:needed], candidates[needed:]
+            results = self.host_manager.claim_resources(
+                where={'hostname': {'$in': batch}, 'state': 'ready', 'distro': distro}, count=needed,
+                changes={'owner': owner, 'state': 'in_use', 'job_id': job_id, 'distro': ''})
+            for result in results:
+                hostname = result['hostname']
+                if port_open(self.systems.get_ip(hostname)):
+                    claimed.append(hostname)
+                else:
+                    print "ERROR: ready host", hostname, "does not answer on port 22"
+                    self.reservation_failed(system_name=hostname, state="needs_repair")
+        if claimed:
+            print "INFO: took ready host(s)", ", ".join(claimed), "from the warm pool"
+        for hostname in claimed:
+            self.host_jobs[hostname] = job_id
+            if hostname not in self.host_reservation:
+                self.host_reservation.append(hostname)
+        return claimed
+
+    def reserve_hosts(self, owner, count, job_id, tags=None):
+        """
+        Pick idle hosts that meet the tag requirements and claim them for the reservation.
+
+        :return: list of the claimed hosts
+        """
         print "INFO: fetching list of idle hosts"
-        available_machines = self.host_manager.find_resources(field="state", value="idle")
+        with self.timer.phase('list_idle_hosts', job_id=job_id) as event:
+            available_machines = self.host_manager.find_resources(field="state", value="idle", fields=["tags"])
+            event['hosts'] = len(available_machines)
         print "INFO: Found {} total machines available".format(
             len(available_machines))
         if any(tags):
@@ -107,48 +267,200 @@ class PxeManager(object):
             print "Oops...There are not enough free resources to fill your request."
             raise UnableToFullfillRequestException()
 
-        print "INFO: Randomizing filtered machines list"
-        random.shuffle(filtered_machines)
-
-        for i in range(count):
-            hostname = filtered_machines[i]['hostname']
-            print "INFO: using host", hostname
-            data = json.dumps({'hostname': hostname, 'owner': owner, 'state': 'pxe', 'job_id': job_id})
-            print "INFO: updating", hostname, "status to pxe"
-            self.host_manager.update_resource(data)
-            print "INFO: finding", hostname, "in Cobbler"
-            simplehost = self.cobbler.find_system({"hostname": hostname})[0]
+        print "INFO: ranking filtered machines with", type(self.placement).__name__
+        filtered_machines = self.placement.rank(filtered_machines, tags)
+
+        candidates = [machine['hostname'] for machine in filtered_machines]
+        with self.timer.phase('claim_hosts', job_id=job_id, count=count):
+            return self.claim_hosts(candidates, count, owner, job_id)
+
+    def wait_for_hosts(self, hostnames, replace, needed=None):
+        """
+        Check all the hosts of a reservation concurrently, each as soon as it has had boot_wait seconds to reboot.
+        A host that fails or times out is dropped from the reservation and, if the hosts still being checked can't
+        make up the reservation anymore, a replacement is kickstarted right away without waiting for the other hosts.
+        Returns once needed hosts are ready.
+
+        Hosts that come up after that are surplus. They are taken out of the reservation before this returns, and
+        released back to idle as soon as their check finishes. The checks are not daemon threads so the interpreter
+        waits for these releases before exiting. If kickstarting a replacement fails, the checks already running are
+        waited for before the error is raised, so the caller can release the reservation without racing them.
+
+        :param hostnames: list of kickstarted hosts
+        :param replace: function kickstarting a replacement host, returns the list of new hosts
+        :param needed: how many hosts the reservation needs, defaults to all of hostnames
+        :return: list of the hosts kept in the reservation
+        """
+        if needed is None:
+            needed = len(hostnames)
+        results = Queue.Queue()
+        ready = []
+        started = []
+        threads = []
+        lock = threading.Lock()
+
+        def check(hostname):
+            try:
+                remaining = self.boot_wait - (time() - self.kickstart_times.get(hostname, 0))
+                if remaining > 0:
+                    print "Waiting", int(remaining), "seconds for", hostname, "to boot"
+                    with self.timer.phase('boot_wait', host=hostname, job_id=self.host_jobs.get(hostname)):
+                        sleep(remaining)
+                print "Checking status of " + hostname
+                passed = self.is_system_ready(system_name=hostname)
+            except Exception as e:
+                print "ERROR: checking", hostname, "failed:", e
+                passed = False
+                try:
+                    self.reservation_failed(system_name=hostname, state="pxe_failed")
+                except Exception as e:
+                    print "ERROR: marking", hostname, "as pxe_failed failed:", e
+            with lock:
+                surplus = passed and len(ready) >= needed
+                if passed and not surplus:
+                    ready.append(hostname)
+                if not passed and hostname in self.host_reservation:
+                    self.host_reservation.remove(hostname)
+            if not passed:
+                print "INFO:", hostname, "was not ready within allotted time. Removing host from reservation."
+            elif surplus:
+                try:
+                    self.release_hosts([hostname])
+                except Exception as e:
+                    print "ERROR: releasing", hostname, "failed:", e
+            results.put((hostname, passed))
+
+        def start(hostname):
+            started.append(hostname)
+            thread = threading.Thread(target=check, args=(hostname,))
+            threads.append(thread)
+            thread.start()
+
+        outstanding = len(hostnames)
+        for hostname in hostnames:
+            start(hostname)
+        while True:
+            with lock:
+                if len(ready) >= needed:
+                    # the hosts still being checked are surplus now
+                    for hostname in started:
+                        if hostname not in ready and hostname in self.host_reservation:
+                            self.host_reservation.remove(hostname)
+                    return list(ready)
             try:
-                print "INFO: placing file on", hostname, "before kickstarting"
-                self.put_file_on_target(ip=self.cobbler.get_system(simplehost)['interfaces']['em1']['ip_address'],
-                                        file_name=self.file_name)
-                print "INFO: adding host", hostname, "to the reservation"
-                if hostname not in self.host_reservation:
-                    self.host_reservation.append(hostname)
-                print "INFO: kickstarting host:", hostname
-                self.kickstart_machine(system_name=hostname, distro=distro)
-            except (BadHostKeyException, AuthenticationException, SSHException, socket.error):
-                print "ERROR: could not reach", hostname, "for preflight checks"
-                self.reservation_failed(system_name=hostname, state="needs_repair")
-                print "INFO: reserving the next available host"
-                self.make_host_reservation(owner=owner, count=1, job_id=job_id, distro=distro, tags=tags)
-
-        '''
-        Check that the resources in the reservation are ready
-        '''
-        print "The reservation is for hosts ", self.host_reservation
-        print "Waiting 2 minutes for systems to boot"
-        sleep(120)
-        for resource in self.host_reservation:
-            print "Checking status of " + resource
-            if not self.is_system_ready(system_name=resource):
-                print "INFO:", resource, "was not ready within allotted time. Removing host from reservation."
-                self.host_reservation.remove(resource)
-                print "INFO: attempting to allocate another machine."
-                self.make_host_reservation(owner=owner, count=1, job_id=job_id, distro=distro, tags=tags)
+                hostname, passed = results.get(timeout=1)
+            except Queue.Empty:
+                continue
+            outstanding -= 1
+            if not passed:
+                with lock:
+                    short = needed - len(ready) - outstanding
+                try:
+                    for _ in range(short):
+                        print "INFO: attempting to allocate another machine."
+                        self.timer.count('host_replacements', host=hostname, job_id=self.host_jobs.get(hostname))
+                        for replacement in replace():
+                            start(replacement)
+                            outstanding += 1
+                except Exception:
+                    for thread in threads:
+                        thread.join()
+                    raise
+
+    def release_hosts(self, hostnames):
+        """
+        Give hosts of a reservation back to the pool as idle.
 
-        print "Request fulfilled."
-        return
+        :param hostnames: list of hosts to release
+        """
+        print "INFO: releasing host(s)", ", ".join(hostnames)
+        for hostname in hostnames:
+            if hostname in self.host_reservation:
+                self.host_reservation.remove(hostname)
+            self.timer.count('hosts_released', host=hostname, job_id=self.host_jobs.pop(hostname, None))
+        results = self.host_manager.update_resources(where={'hostname': {'$in': hostnames}},
+                                                     changes={'owner': '', 'state': 'idle', 'job_id': ''})
+        self.check_freed(results, 'hostname')
+
+    def provision_hosts(self, hostnames, distro):
+        """
+        Run the preflight check on each host, up to self.parallelism hosts at the same time, then kickstart all the
+        hosts that passed together with kickstart_machines.
+
+        :param hostnames: list of hosts claimed for the reservation
+        :param distro: what OS to install
+        :return: list of the hosts that failed preflight checks or could not be rebooted
+        """
+        if self.parallelism > 1 and len(hostnames) > 1:
+            pool = ThreadPool(min(self.parallelism, len(hostnames)))
+            try:
+                results = pool.map(self.preflight_host, hostnames)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.preflight_host(hostname) for hostname in hostnames]
+        ready_hosts = [hostname for hostname, passed in zip(hostnames, results) if passed]
+        failed_hosts = [hostname for hostname, passed in zip(hostnames, results) if not passed]
+        if ready_hosts:
+            _, state = self.kickstart_machines(ready_hosts, distro)
+            if state != "complete":
+                failed_hosts.extend(ready_hosts)
+        return failed_hosts
+
+    def preflight_host(self, hostname):
+        """
+        Place the kickstart marker file on a host and add it to the reservation. A host that can't be reached for
+        the preflight check is marked as needing repair.
+
+        :param hostname: host to check
+        :return: True if the host is ready to be kickstarted
+        """
+        print "INFO: using host", hostname
+        print "INFO: finding", hostname, "in Cobbler"
+        ip = self.systems.get_ip(hostname)
+        try:
+            print "INFO: placing file on", hostname, "before kickstarting"
+            with self.timer.phase('preflight', host=hostname, job_id=self.host_jobs.get(hostname)):
+                self.put_file_on_target(ip=ip, file_name=self.file_name)
+            print "INFO: adding host", hostname, "to the reservation"
+            if hostname not in self.host_reservation:
+                self.host_reservation.append(hostname)
+            return True
+        except (BadHostKeyException, AuthenticationException, SSHException, socket.error):
+            print "ERROR: could not reach", hostname, "for preflight checks"
+            self.reservation_failed(system_name=hostname, state="needs_repair")
+            return False
+
+    def claim_hosts(self, candidates, count, owner, job_id):
+        """
+        Atomically move count of the candidate hosts from idle to pxe for this reservation, in candidate order. Hosts
+        taken by a concurrent reservation since the candidates were listed are replaced by the next candidates.
+
+        :param candidates: list of hostnames in order of preference
+        :param count: how many hosts to claim
+        :param owner: who the reservation is for
+        :param job_id: unique identifier for the reservation
+        :return: list of the claimed hostnames
+        """
+        claimed = []
+        while len(claimed) < count and candidates:
+            needed = count - len(claimed)
+            batch, candidates = candidates[:needed], candidates[needed:]
+            print "INFO: updating", ", ".join(batch), "status to pxe"
+            results = self.host_manager.claim_resources(where={'hostname': {'$in': batch}, 'state': 'idle'},
+                                                        count=needed,
+                                                        changes={'owner': owner, 'state': 'pxe', 'job_id': job_id})
+            claimed.extend(result['hostname'] for result in results)
+        for hostname in claimed:
+            self.host_jobs[hostname] = job_id
+        if len(claimed) < count:
+            print "Oops...Other reservations took the free resources before we could claim them."
+            if claimed:
+                self.host_manager.update_resources(where={'hostname': {'$in': claimed}},
+                                                   changes={'owner': '', 'state': 'idle', 'job_id': ''})
+            raise UnableToFullfillRequestException()
+        return claimed
 
     def kickstart_machine(self, system_name, distro):
         """
@@ -158,18 +470,77 @@ class PxeManager(object):
         :param distro:
         :return:
         """
-        print "INFO: fetching", system_name, "from Cobbler and setting profile"
-        simplehost = self.cobbler.find_system({"hostname": system_name})[0]
-        system_handle = self.cobbler.get_system_handle(simplehost, self.token)
-        self.cobbler.modify_system(system_handle, "profile", self.distro[distro], self.token)
-        self.cobbler.modify_system(system_handle, "netboot-enabled", 1, self.token)
-        self.cobbler.save_system(system_handle, self.token)
-
-        reboot_args = {"power": "reboot", "systems": [simplehost]}
-        print "INFO: Cobbler is rebooting", system_name
-        self.cobbler.background_power_system(reboot_args, self.token)
+        self.kickstart_machines([system_name], distro)
         return
 
+    def kickstart_machines(self, system_names, distro, wait=True):
+        """
+        Kickstart several machines with the specified OS. The profile and netboot changes for all of them are sent
+        to cobbler in one batch, then a single background power task reboots them all. If the power task fails or
+        doesn't finish in time, the machines are marked pxe_failed and taken out of the reservation, there is no
+        point in waiting for them to come up.
+
+        :param system_names: list of hostnames to kickstart
+        :param distro: what OS to install (see the dict "distro" for valid options)
+        :param wait: wait for the power task to finish before returning
+        :return: (id of the cobbler power task, its final state: "complete", "failed", None if it timed out or
+                 wait is False)
+        """
+        job_ids = sorted(set(self.host_jobs.get(system_name) for system_name in system_names))
+        tags = {'host': ",".join(system_names), 'job_id': ",".join(str(job_id) for job_id in job_ids)}
+        print "INFO: fetching", ", ".join(system_names), "from Cobbler and setting profile"
+        with self.timer.phase('cobbler_set_profile', **tags):
+            simplehosts = [self.systems.get_system_name(system_name) for system_name in system_names]
+            handles = self.cobbler.batch([('get_system_handle', (simplehost,)) for simplehost in simplehosts],
+                                         authenticated=True)
+            edits = []
+            for handle in handles:
+                edits.extend([('modify_system', (handle, "profile", self.distro[distro])),
+                              ('modify_system', (handle, "netboot-enabled", 1)),
+                              ('save_system', (handle,))])
+            self.cobbler.batch(edits, authenticated=True)
+
+        reboot_args = {"power": "reboot", "systems": simplehosts}
+        print "INFO: Cobbler is rebooting", ", ".join(system_names)
+        with self.timer.phase('cobbler_power', **tags) as event:
+            task_id = self.cobbler.call_authenticated('background_power_system', reboot_args)
+            now = time()
+            for system_name in system_names:
+                self.kickstart_times[system_name] = now
+            self.power_tasks[task_id] = system_names
+            state = None
+            if wait:
+                state = self.wait_for_task(task_id)
+                event['status'] = state or 'timeout'
+        if wait and state != "complete":
+            for system_name in system_names:
+                print "INFO: updating", system_name, "status to pxe_failed"
+                self.reservation_failed(system_name=system_name, state="pxe_failed")
+                if system_name in self.host_reservation:
+                    self.host_reservation.remove(system_name)
+        return task_id, state
+
+    def wait_for_task(self, task_id, interval=5, timeout=600):
+        """
+        Poll a cobbler background task until it finishes.
+
+        :param task_id: id returned when the task was started
+        :param interval: seconds between polls
+        :param timeout: seconds to wait before giving up
+        :return: the final state of the task ("complete" or "failed"), None if it didn't finish in time
+        """
+        deadline = time() + timeout
+        while time() < deadline:
+            state = self.cobbler.get_task_status(task_id)[2]
+            if state in ("complete", "failed"):
+                if state == "failed":
+                    print "ERROR: cobbler task", task_id, "for", ", ".join(self.power_tasks.get(task_id, [])), \
+                        "failed, see the task log on the cobbler server"
+                return state
+            sleep(interval)
+        print "ERROR: cobbler task", task_id, "did not finish within", timeout, "seconds"
+        return None
+
     def is_system_ready(self, system_name):
         """
         Check that a given system can be reached via ssh after it is kickstarted. If it cannot be reached we will
@@ -180,23 +551,34 @@ class PxeManager(object):
         :param system_name: name of the system to check
         :return:
         """
-        simplehost = self.cobbler.find_system({"hostname": system_name})[0]
-        sys_ip = self.cobbler.get_system(simplehost)['interfaces']['em1']['ip_address']
-        if self.check_ssh(ip=sys_ip):
-            if self.check_for_file_on_target(ip=sys_ip, file_name=self.file_name):
+        tags = {'host': system_name, 'job_id': self.host_jobs.get(system_name)}
+        sys_ip = self.systems.get_ip(system_name)
+        try:
+            with self.timer.phase('ssh_wait', **tags) as event:
+                reachable = self.check_ssh(ip=sys_ip)
+                if not reachable:
+                    event['status'] = 'failed'
+            if reachable:
+                with self.timer.phase('kickstart_check', **tags) as event:
+                    if self.check_for_file_on_target(ip=sys_ip, file_name=self.file_name):
+                        event['status'] = 'failed'
+                        self.reservation_failed(system_name=system_name, state="pxe_failed")
+                        return False
+                print "File that was created on", system_name, "before kickstart was not detected.\n" \
+                      "KICKSTART SUCCEEDED!"
+                data = json.dumps({'hostname': system_name, 'state': 'in_use'})
+                print "INFO: updating", system_name, "status to in_use"
+                self.host_manager.update_resource(data)
+                return True
+            else:
+                print "INFO: updating", system_name, "status to pxe_failed"
                 self.reservation_failed(system_name=system_name, state="pxe_failed")
-                return False
-            print "File that was created on", system_name, "before kickstart was not detected.\nKICKSTART SUCCEEDED!"
-            data = json.dumps({'hostname': system_name, 'state': 'in_use'})
-            print "INFO: updating", system_name, "status to in_use"
-            self.host_manager.update_resource(data)
-            return True
-        else:
-            print "INFO: updating", system_name, "status to pxe_failed"
-            self.reservation_failed(system_name=system_name, state="pxe_failed")
-        return False
+            return False
+        finally:
+            self.ssh.close(sys_ip)
 
     def reservation_failed(self, system_name, state):
+        self.timer.count('hosts_' + state, host=system_name, job_id=self.host_jobs.pop(system_name, None))
         data = json.dumps({'hostname': system_name, 'owner': '', 'state': state, 'job_id': ''})
         self.host_manager.update_resource(data)
 
@@ -208,28 +590,24 @@ class PxeManager(object):
         :param value:
         :return:
         """
-        resources = self.host_manager.find_resources(field=field, value=value)
-        for resource in resources:
-            system_name = resource['hostname']
-            print "Freeing " + system_name
-            data = json.dumps({'hostname': system_name, 'owner': '', 'state': 'idle', 'job_id': ''})
-            self.host_manager.update_resource(data)
+        results = self.host_manager.update_resources(where={field: value},
+                                                     changes={'owner': '', 'state': 'idle', 'job_id': ''})
+        self.check_freed(results, 'hostname')
         return
 
     def put_file_on_target(self, ip, file_name):
         """
         SSH to a host and touch a file there. We can later check for this files existence to determine whether a
-        kickstart completed successfully.
+        kickstart completed successfully. The session is closed afterwards since the host is about to be rebooted.
 
         :param ip: (string) IP address of host
         :param file_name: name of file to create
         :return:
         """
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())  # wont require saying 'yes' to new fingerprint
-        ssh.connect(ip, username=self.ssh_user, password=self.ssh_password)
-        ssh.exec_command('touch ' + file_name)
-        ssh.close()
+        try:
+            self.ssh.run(ip, 'touch ' + file_name)
+        finally:
+            self.ssh.close(ip)
         return
 
     def check_for_file_on_target(self, ip, file_name):
@@ -240,42 +618,49 @@ class PxeManager(object):
         :param file_name: Name of file to check if it exists
         :return: True if the file was found
         """
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())  # wont require saying 'yes' to new fingerprint
-        ssh.connect(ip, username=self.ssh_user, password=self.ssh_password)
         command = "[ -f /root/" + file_name + " ] && echo OK"
-        _, stdout, _ = ssh.exec_command(command)
-        if stdout.read():
-            ssh.close()
+        _, output = self.ssh.run(ip, command)
+        if output:
             print "Found a file that should not have been on the host"
             return True
-        ssh.close()
         return False
 
-    def check_ssh(self, ip, interval=20, retries=45):
+    def check_ssh(self, ip, interval=20, retries=45, probe_timeout=3, min_backoff=1):
         """
-        Attempt to ssh to a given host. Default is to try for 15 minutes
+        Attempt to ssh to a given host. Default is to try for 15 minutes. Port 22 is probed with a plain TCP connect
+        first and a login is only attempted once it accepts connections. The wait between probes starts at
+        min_backoff seconds and doubles up to interval, with jitter. It starts over when the port goes from closed to
+        open, and keeps doubling after failed logins. The session is kept open for the checks that follow.
 
         :param ip: ip of host to try
-        :param user: user to log in as
-        :param password: user login password
-        :param interval: seconds between retries
-        :param retries: number of retries
+        :param interval: maximum seconds between retries
+        :param retries: number of intervals to try for
+        :param probe_timeout: seconds to wait for the port to accept a connection
+        :param min_backoff: seconds between the first retries
         :return:
         """
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-
-        for i in range(retries):
-            try:
-                print "Attempting ssh to " + ip + "....." + str(i+1) + "/" + str(retries)
-                ssh.connect(ip, username=self.ssh_user, password=self.ssh_password)
-                print "Obtained ssh connection to " + ip + "!"
-                return True
-            except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
-                print e
-                sleep(interval)
-        return False
+        deadline = time() + interval * retries
+        backoff = min_backoff
+        was_open = False
+        while True:
+            is_open = port_open(ip, timeout=probe_timeout)
+            if is_open and not was_open:
+                # sshd is coming up, retry soon
+                backoff = min_backoff
+            was_open = is_open
+            if is_open:
+                try:
+                    print "Attempting ssh to " + ip
+                    self.ssh.connect(ip)
+                    print "Obtained ssh connection to " + ip + "!"
+                    return True
+                except (BadHostKeyException, AuthenticationException, SSHException, socket.error) as e:
+                    print e
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(random.uniform(min_backoff, backoff), remaining))
+            backoff = min(backoff * 2, interval)
 
     def get_host_reservation_as_ip(self, reservation):
         """
@@ -284,11 +669,7 @@ class PxeManager(object):
         :param reservation: An array of hostnames to get IPs of
         :return: An array of IPs
         """
-        reservation_ips = []
-        for item in reservation:
-            simplehost = self.cobbler.find_system({"hostname": item})[0]
-            reservation_ips.append(self.cobbler.get_system(simplehost)['interfaces']['em1']['ip_address'])
-        return reservation_ips
+        return [self.systems.get_ip(item) for item in reservation]
 
     def get_individual_reservation_as_ip(self, reservation):
         """
@@ -296,17 +677,18 @@ class PxeManager(object):
         :param reservation:
         :return: single IP as string
         """
-        reservation_ip = None
-        simplehost = self.cobbler.find_system({"hostname": reservation})[0]
-        reservation_ip = self.cobbler.get_system(simplehost)['interfaces']['em1']['ip_address']
-        return reservation_ip
+        return self.systems.get_ip(reservation)
 
-    def make_ip_reservation(self, ip_type, job_id, number_of_ips, tags=None):
+    def make_ip_reservation(self, ip_type, job_id, number_of_ips, tags=None, attempts=3):
         """
         Used to make a reservation of public or private IPs.  Typically the job_id would be the jenkins job or some
         other string that would be unique to the entire reservation. This makes it easier to free the IPs associated
         with the reservation. However, an user's name can also be used*.
 
+        The IPs are picked as a contiguous block when the pool has one (see IPRangeAllocator) and the whole block is
+        claimed in one request. Addresses of the block taken by a concurrent reservation in the meantime are
+        replaced by picking again, up to attempts times.
+
         *Use caution when using a user's name when freeing as that would free all for that person. If a user name is
         used for the reservation it is best practice to free those by IP address
 
@@ -314,6 +696,7 @@ class PxeManager(object):
         :param ip_type: Type of IP reservation to make (public/private)
         :param job_id: job_id or owner to make the reservation for
         :param number_of_ips: how many IPs to reserve
+        :param attempts: how many times to pick and claim addresses before giving up
         :return: an array of the IPs that were reserved
         """
         type_dict = {'public': self.public_ip_manager,
@@ -321,19 +704,49 @@ class PxeManager(object):
         reservation_dict = {'public': self.public_ip_reservation,
                             'private': self.private_ip_reservation}
         ip_manager = type_dict[ip_type]
-        free_addresses = ip_manager.find_resources(field="owner", value="")
-        filtered_addresses = self.filter_resources_by_tags(free_addresses, tags)
-        if len(filtered_addresses) < number_of_ips:
+        if number_of_ips <= 0:
+            return reservation_dict[ip_type]
+        # tags are matched exactly, so the whole filter can be applied by the server
+        where = {'owner': ''}
+        for tag, value in (tags or {}).iteritems():
+            where['tags.' + tag] = value
+        addresses = []
+        with self.timer.phase('ip_reservation', job_id=job_id, ip_type=ip_type, count=number_of_ips) as event:
+            for _ in range(attempts):
+                needed = number_of_ips - len(addresses)
+                free = [result['address'] for result in ip_manager.query_resources(where=where, fields=['address'])]
+                block = IPRangeAllocator(free).allocate(needed)
+                if len(block) < needed:
+                    break
+                query = dict(where)
+                query['address'] = {'$in': block}
+                claimed = ip_manager.claim_resources(where=query, count=needed, changes={'owner': job_id})
+                addresses.extend(result['address'] for result in claimed)
+                if len(addresses) == number_of_ips:
+                    break
+            if len(addresses) < number_of_ips:
+                event['status'] = 'failed'
+        if len(addresses) < number_of_ips:
             print "Oops...There are not enough free IPs to fill your request."
+            if addresses:
+                ip_manager.update_resources(where={'address': {'$in': addresses}}, changes={'owner': ''})
             raise UnableToFullfillRequestException()
 
-        for i in range(number_of_ips):
-            address = filtered_addresses[i]['address']
-            data = json.dumps({'address': address, 'owner': job_id})
-            ip_manager.update_resource(data)
-            reservation_dict[ip_type].append(address)
+        reservation_dict[ip_type].extend(addresses)
         return reservation_dict[ip_type]
 
+    def get_ip_reservation_as_ranges(self, ip_type):
+        """
+        The IPs reserved so far as "first-last" ranges, ready to be passed to config_manager's Network, ex:
+        network.add_public_ip_entry(",".join(pxe_manager.get_ip_reservation_as_ranges('public')))
+
+        :param ip_type: Type of IP reservation (public/private)
+        :return: list of ranges and single addresses
+        """
+        reservation_dict = {'public': self.public_ip_reservation,
+                            'private': self.private_ip_reservation}
+        return to_ranges(reservation_dict[ip_type])
+
     def free_ip_reservation(self, ip_type, field="owner", value=""):
         """
         Free ip reservation. Usually you would free by owner:job_id to free all for a particular reservation. However,
@@ -350,15 +763,29 @@ class PxeManager(object):
         """
         type_dict = {'public': self.public_ip_manager,
                      'private': self.private_ip_manager}
-        ip_type = type_dict[ip_type]
-        resources = ip_type.find_resources(field=field, value=value)
-        for resource in resources:
-            address = resource['address']
-            print "Freeing " + address
-            data = json.dumps({'address': address, 'owner': ''})
-            ip_type.update_resource(data)
+        with self.timer.phase('free_ip_reservation', ip_type=ip_type, field=field, value=value):
+            results = type_dict[ip_type].update_resources(where={field: value}, changes={'owner': ''})
+        self.check_freed(results, 'address')
         return
 
+    def check_freed(self, results, key):
+        """
+        Report the result of a bulk update freeing resources.
+
+        :param results: items returned by update_resources
+        :param key: field naming the resources
+        :raises FreeResourcesException: if some of the resources could not be freed
+        """
+        failures = []
+        for result in results:
+            if result.get('_status') == 'OK':
+                print "Freeing " + result[key]
+            else:
+                print "ERROR: could not free", result.get(key), result.get('_issues')
+                failures.append(result)
+        if failures:
+            raise FreeResourcesException(failures)
+
     def filter_resources_by_tags(self, resources, tags):
         """
         Filter a list of resources down to the ones that have the tags passed in
@@ -369,34 +796,7 @@ class PxeManager(object):
         """
         if not tags:
             return resources
-        matching_resources = []
-        # For each resource
-        for resource in resources:
-            # Check that each tag is available, if so add it to the returned array
-            all_tags_valid = True
-            for tag in tags.keys():
-                if tag not in resource['tags'] or resource['tags'][tag] != tags[tag]:
-                    all_tags_valid = False
-            if all_tags_valid:
-                matching_resources.append(resource)
-        return matching_resources
-
-    def compare_tag(self, name, value, oper, tags):
-        """
-        Utility function to simplify the testing of key/value pairs in filtering
-        function.
-        :param name: Name of the key/value pair to compare
-        :param value: Value to compare
-        :param oper: what is our operation?
-        :param tags: tags from the host entry in the mongodb
-        :return:
-        """
-        # we will use a 10% fudge factor because memory is not exact
-        if 'memory' in name:
-            value *= .9
-        if name in tags and oper(tags[name], value):
-            return True
-        return False
+        return TagIndex(resources).match(tags, ranges=False)
 
     def filter_hosts_by_tags(self, resources, tags):
         """
@@ -410,17 +810,4 @@ class PxeManager(object):
         :param tags: tags that we are filtering against
         :return: list of dicts
         """
-        matching_resources = []
-        oper = operator.eq
-        for r in resources:
-            found = True
-            for name, filters in tags.iteritems():
-                if isinstance(filters, int):
-                    oper = operator.ge
-                if not self.compare_tag(name, value=filters,
-                                        oper=oper, tags=r['tags']):
-                    found = False
-                    break
-            if found:
-                matching_resources.append(r)
-        return matching_resources
+        return TagIndex(resources).match(tags)
@@ -0,0 +1,329 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import argparse
+import Queue
+import threading
+import traceback
+import uuid
+
+import requests
+from flask import Flask, abort, jsonify, request
+from time import time
+
+from pxe_manager.pxemanager import PxeManager, UnableToFullfillRequestException
+from pxe_manager.warmpool import WarmPool
+
+
+class Ticket(object):
+    def __init__(self, owner, count, job_id, distro, tags=None, spares=0):
+        """
+        A host reservation submitted to a ReservationService, and its progress.
+
+        :param owner: who the reservation is for
+        :param count: how many machines to reserve
+        :param job_id: unique identifier for the reservation
+        :param distro: what OS to install
+        :param tags: Dict of tags to filter machines on
+        :param spares: how many extra machines to kickstart up front
+        """
+        self.id = uuid.uuid4().hex
+        self.request = {'owner': owner, 'count': count, 'job_id': job_id, 'distro': distro, 'tags': tags or {},
+                        'spares': spares}
+        self.state = 'queued'
+        self.hosts = []
+        self.error = None
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def finish(self, state, hosts=None, error=None):
+        self.state = state
+        self.hosts = hosts or []
+        self.error = error
+        self.finished = time()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: seconds to wait, forever if None
+        :return: True if the reservation finished
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+    def to_dict(self):
+        return {'id': self.id, 'request': self.request, 'state': self.state, 'hosts': self.hosts,
+                'error': self.error, 'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+
+
+class ReservationService(object):
+    def __init__(self, pxe_manager, workers=4, ticket_ttl=86400, warm_pool=None):
+        """
+        Run host reservations in the background from a shared pool of workers. Callers submit a reservation, get a
+        Ticket back right away and poll or wait on it. All the reservations share the Cobbler client, the SSH
+        sessions and the cobbler system index of pxe_manager, and at most workers reservations run at the same time.
+
+        :param pxe_manager: (PxeManager) manager the reservations are made with
+        :param workers: (int) how many reservations run at the same time
+        :param ticket_ttl: (int) seconds a finished ticket is kept around for callers to collect
+        :param warm_pool: (WarmPool) pool of ready hosts to replenish after each reservation
+        """
+        self.pxe_manager = pxe_manager
+        self.workers = workers
+        self.ticket_ttl = ticket_ttl
+        self.warm_pool = warm_pool
+        self.tickets = {}
+        self.queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='reservation-worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Let the workers finish the reservations they are running and stop them. Reservations still queued are not
+        run, their tickets fail.
+        """
+        while True:
+            try:
+                ticket = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if ticket is not None:
+                ticket.finish('failed', error='The reservation service was stopped')
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, owner, count, job_id, distro, tags=None, spares=0):
+        """
+        Queue a host reservation, see PxeManager.make_host_reservation for the parameters.
+
+        :return: Ticket of the reservation
+        """
+        for name, value in (('owner', owner), ('job_id', job_id)):
+            if not isinstance(value, basestring) or not value:
+                raise ValueError('{0} must be a non empty string'.format(name))
+        if distro not in self.pxe_manager.distro:
+            raise ValueError('Unknown distro "{0}", expected one of: {1}'.format(
+                distro, ", ".join(sorted(self.pxe_manager.distro))))
+        if not isinstance(count, int) or count < 1:
+            raise ValueError('count must be a positive integer')
+        ticket = Ticket(owner, count, job_id, distro, tags, spares)
+        with self._lock:
+            self._prune()
+            self.tickets[ticket.id] = ticket
+        self.queue.put(ticket)
+        return ticket
+
+    def get(self, ticket_id):
+        """
+        :return: the Ticket with this id
+        :raises KeyError: if there is no such ticket
+        """
+        with self._lock:
+            return self.tickets[ticket_id]
+
+    def _prune(self):
+        expired = time() - self.ticket_ttl
+        for ticket_id, ticket in self.tickets.items():
+            if ticket.done() and ticket.finished < expired:
+                del self.tickets[ticket_id]
+
+    def _work(self):
+        while True:
+            ticket = self.queue.get()
+            if ticket is None:
+                return
+            try:
+                self.run(ticket)
+            except Exception as e:
+                # keep the worker alive, a dead one shrinks the pool for good
+                traceback.print_exc()
+                if not ticket.done():
+                    ticket.finish('failed', error=str(e) or type(e).__name__)
+
+    def run(self, ticket):
+        """
+        Make the reservation of a ticket on its own copy of the PxeManager, see PxeManager.for_reservation. A
+        reservation that fails releases the machines it holds, and only those. The ticket is failed even when that
+        release fails.
+        """
+        ticket.state = 'running'
+        ticket.started = time()
+        manager = self.pxe_manager.for_reservation()
+        try:
+            manager.make_host_reservation(**ticket.request)
+        except UnableToFullfillRequestException:
+            error = 'Not enough free machines to fulfill the request'
+        except Exception as e:
+            traceback.print_exc()
+            error = str(e) or type(e).__name__
+        else:
+            error = None
+        if error is None:
+            ticket.finish('done', hosts=list(manager.host_reservation))
+        else:
+            try:
+                self.release(manager)
+            except Exception as e:
+                traceback.print_exc()
+                error += ' (releasing its machines failed too: {0})'.format(str(e) or type(e).__name__)
+            ticket.finish('failed', error=error)
+        if self.warm_pool is not None:
+            self.warm_pool.notify(ticket.request['distro'])
+
+    def release(self, manager):
+        if manager.host_reservation:
+            manager.release_hosts(list(manager.host_reservation))
+
+
+def create_app(service, max_wait=300):
+    """
+    HTTP interface of a ReservationService:
+
+        POST /reservations {"owner": "tony", "count": 3, "job_id": "job-1", "distro": "centos"} -> 202, ticket
+        GET /reservations/<id>?wait=60 -> 200, ticket, once it is done or after up to 60 seconds
+
+    :param service: (ReservationService) service to expose
+    :param max_wait: (int) longest a GET may wait for a ticket to finish
+    :return: Flask app
+    """
+    app = Flask(__name__)
+
+    @app.route('/reservations', methods=['POST'])
+    def submit():
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            abort(400, description='Request body must be a JSON object')
+        try:
+            ticket = service.submit(owner=body.get('owner'), count=body.get('count'), job_id=body.get('job_id'),
+                                    distro=body.get('distro'), tags=body.get('tags'), spares=body.get('spares', 0))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(ticket.to_dict()), 202
+
+    @app.route('/reservations/<ticket_id>', methods=['GET'])
+    def status(ticket_id):
+        try:
+            ticket = service.get(ticket_id)
+        except KeyError:
+            abort(404)
+        wait = request.args.get('wait', 0, type=float)
+        if wait > 0:
+            ticket.wait(min(wait, max_wait))
+        return jsonify(ticket.to_dict())
+
+    return app
+
+
+class ReservationClient(object):
+    def __init__(self, endpoint='http://127.0.0.1:5050', poll_wait=60):
+        """
+        Client of the reservation service HTTP interface.
+
+        :param endpoint: base URL of the service
+        :param poll_wait: seconds each status request waits on the server for the reservation to finish
+        """
+        self.endpoint = endpoint
+        self.poll_wait = poll_wait
+        self.session = requests.Session()
+
+    def submit(self, owner, count, job_id, distro, tags=None, spares=0):
+        """
+        :return: ticket dict, its 'id' is used to follow the reservation
+        """
+        response = self.session.post(self.endpoint + '/reservations',
+                                     json={'owner': owner, 'count': count, 'job_id': job_id, 'distro': distro,
+                                           'tags': tags or {}, 'spares': spares})
+        response.raise_for_status()
+        return response.json()
+
+    def status(self, ticket_id, wait=0):
+        response = self.session.get(self.endpoint + '/reservations/' + ticket_id, params={'wait': wait},
+                                    timeout=wait + 30)
+        response.raise_for_status()
+        return response.json()
+
+    def wait(self, ticket_id, timeout=None):
+        """
+        Wait for a reservation to finish.
+
+        :param ticket_id: id of the ticket
+        :param timeout: seconds to wait, forever if None
+        :return: the ticket dict, its 'state' is still "queued" or "running" if the timeout expired
+        """
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            wait = self.poll_wait if deadline is None else max(0, min(self.poll_wait, deadline - time()))
+            ticket = self.status(ticket_id, wait=wait)
+            if ticket['state'] in ('done', 'failed') or (deadline is not None and time() >= deadline):
+                return ticket
+
+
+if __name__ == "__main__":
+    from resource_manager.client import ResourceManagerClient
+
+    parser = argparse.ArgumentParser(description='Run host reservations in the background.')
+    parser.add_argument('--cobbler-url', required=True, help='URL of the cobbler API')
+    parser.add_argument('--cobbler-user', required=True)
+    parser.add_argument('--cobbler-password', required=True)
+    parser.add_argument('--resource-manager', default='http://127.0.0.1:5000', help='Resource manager endpoint')
+    parser.add_argument('--workers', default=4, type=int, help='Reservations running at the same time')
+    parser.add_argument('--parallelism', default=4, type=int, help='Hosts of a reservation provisioned at once')
+    parser.add_argument('--warm', action='append', default=[], metavar='DISTRO=COUNT',
+                        help='Keep COUNT hosts kickstarted with DISTRO ready, ex: --warm centos=4')
+    parser.add_argument('--port', default=5050, type=int)
+    args = parser.parse_args()
+    pxe_manager = PxeManager(args.cobbler_url, args.cobbler_user, args.cobbler_password,
+                             ResourceManagerClient('machines', args.resource_manager),
+                             ResourceManagerClient('public-addresses', args.resource_manager),
+                             ResourceManagerClient('private-addresses', args.resource_manager),
+                             parallelism=args.parallelism)
+    warm_pool = None
+    if args.warm:
+        targets = dict((distro, int(count)) for distro, count in (warm.split('=') for warm in args.warm))
+        warm_pool = WarmPool(pxe_manager, targets)
+        warm_pool.start()
+    service = ReservationService(pxe_manager, workers=args.workers, warm_pool=warm_pool)
+    service.start()
+    create_app(service).run(host='0.0.0.0', port=args.port, threaded=True)
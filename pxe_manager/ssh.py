@@ -0,0 +1,141 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import socket
+import threading
+
+from time import time
+from paramiko import SSHClient, AutoAddPolicy
+
+
+def port_open(ip, port=22, timeout=3):
+    """
+    Check whether a host accepts TCP connections on a port, without the cost of an SSH handshake.
+
+    :param ip: (string) IP address of host
+    :param port: (int) port to connect to
+    :param timeout: (int) seconds to wait for the connection
+    :return: True if the connection was accepted
+    """
+    try:
+        sock = socket.create_connection((ip, port), timeout)
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+
+class SSHSessionManager(object):
+    def __init__(self, user, password, max_sessions=32, connect_timeout=30):
+        """
+        Cache of authenticated SSH connections by host, so the commands run on a host share one handshake. At most
+        max_sessions connections are kept open, the least recently used one is closed to make room for a new one.
+
+        :param user: (string) user to log in as
+        :param password: (string) password of the user
+        :param max_sessions: (int) maximum number of connections kept open
+        :param connect_timeout: (int) seconds to wait for a connection to be established
+        """
+        self.user = user
+        self.password = password
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self.sessions = {}
+        self.last_used = {}
+        self._lock = threading.Lock()
+
+    def connect(self, ip):
+        """
+        Open a new session to a host, replacing the cached one if there is one.
+
+        :param ip: (string) IP address of host
+        :return: connected paramiko SSHClient
+        """
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())  # wont require saying 'yes' to new fingerprint
+        try:
+            client.connect(ip, username=self.user, password=self.password, timeout=self.connect_timeout)
+        except:
+            client.close()
+            raise
+        stale = []
+        with self._lock:
+            if ip in self.sessions:
+                stale.append(self.sessions[ip])
+            self.sessions[ip] = client
+            self.last_used[ip] = time()
+            while len(self.sessions) > self.max_sessions:
+                oldest = min(self.last_used, key=self.last_used.get)
+                stale.append(self.sessions.pop(oldest))
+                del self.last_used[oldest]
+        for session in stale:
+            session.close()
+        return client
+
+    def get(self, ip):
+        """
+        :param ip: (string) IP address of host
+        :return: the cached session to a host if it is still alive, otherwise a new one
+        """
+        with self._lock:
+            client = self.sessions.get(ip)
+            if client is not None:
+                self.last_used[ip] = time()
+        transport = client.get_transport() if client is not None else None
+        if transport is not None and transport.is_active():
+            return client
+        return self.connect(ip)
+
+    def run(self, ip, command):
+        """
+        Run a command on a host over its cached session and wait for it to finish.
+
+        :param ip: (string) IP address of host
+        :param command: (string) command to run
+        :return: (exit status, output) of the command
+        """
+        _, stdout, _ = self.get(ip).exec_command(command)
+        output = stdout.read()
+        return stdout.channel.recv_exit_status(), output
+
+    def close(self, ip):
+        with self._lock:
+            client = self.sessions.pop(ip, None)
+            self.last_used.pop(ip, None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = self.sessions.values()
+            self.sessions = {}
+            self.last_used = {}
+        for client in clients:
+            client.close()
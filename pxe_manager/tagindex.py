@@ -0,0 +1,101 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+from bisect import bisect_left
+from numbers import Number
+
+
+class TagIndex(object):
+    def __init__(self, resources):
+        """
+        In memory index of a snapshot of resources by tag, so a multi-tag query is an intersection of a few sets
+        instead of a comparison of every tag of every resource. Every tag value gets an equality map, numeric tags
+        (memory, cpucores...) also get a sorted array for "at least" queries.
+
+        :param resources: list of resource documents, each with a 'tags' dict
+        """
+        self.resources = resources
+        self.equal = {}
+        numeric = {}
+        for position, resource in enumerate(resources):
+            for name, value in resource.get('tags', {}).items():
+                try:
+                    self.equal.setdefault(name, {}).setdefault(value, set()).add(position)
+                except TypeError:
+                    # unhashable tag values (lists, dicts) are matched by a scan in equal_to
+                    pass
+                if isinstance(value, Number):
+                    numeric.setdefault(name, []).append((value, position))
+        self.numeric = {}
+        for name, entries in numeric.items():
+            entries.sort()
+            self.numeric[name] = ([value for value, _ in entries], [position for _, position in entries])
+
+    def equal_to(self, name, value):
+        """
+        :return: set of the positions of the resources where tag name equals value
+        """
+        try:
+            return self.equal.get(name, {}).get(value, set())
+        except TypeError:
+            return set(position for position, resource in enumerate(self.resources)
+                       if name in resource.get('tags', {}) and resource['tags'][name] == value)
+
+    def at_least(self, name, value):
+        """
+        Memory is not exact so a resource with at least 90% of the requested memory matches.
+
+        :return: set of the positions of the resources where tag name is greater than or equal to value
+        """
+        if 'memory' in name:
+            value *= .9
+        values, positions = self.numeric.get(name, ([], []))
+        return set(positions[bisect_left(values, value):])
+
+    def match(self, tags, ranges=True):
+        """
+        Find the resources that have all the requested tags.
+
+        :param tags: dict of tags to match
+        :param ranges: when True integer tags match values greater than or equal to the requested one, otherwise
+                       every tag has to be equal
+        :return: list of the matching resources, in snapshot order
+        """
+        if not tags:
+            return list(self.resources)
+        matches = []
+        for name, value in tags.items():
+            if ranges and isinstance(value, int):
+                matches.append(self.at_least(name, value))
+            else:
+                matches.append(self.equal_to(name, value))
+        matches.sort(key=len)
+        positions = matches[0].intersection(*matches[1:])
+        return [self.resources[position] for position in sorted(positions)]
@@ -0,0 +1,90 @@
+import mock
+import threading
+import xmlrpclib
+
+from pxe_manager.cobbler import CobblerClient, CobblerSystemIndex, SystemNotFoundException
+
+systems = [{'name': 'a-01', 'hostname': 'a-01.example.com',
+            'interfaces': {'em1': {'ip_address': '10.0.0.1'}, 'em2': {'ip_address': '192.168.0.1'}}},
+           {'name': 'a-02', 'hostname': 'a-02.example.com',
+            'interfaces': {'em1': {'ip_address': '10.0.0.2'}}}]
+
+
+def test_index_lookups():
+    get_systems = mock.Mock(return_value=systems)
+    index = CobblerSystemIndex(get_systems)
+    assert index.get_ip('a-01.example.com') == '10.0.0.1'
+    assert index.get_ip('a-01.example.com', interface='em2') == '192.168.0.1'
+    assert index.get_system_name('a-02.example.com') == 'a-02'
+    assert get_systems.call_count == 1
+
+
+def test_index_refresh():
+    get_systems = mock.Mock(return_value=systems)
+    index = CobblerSystemIndex(get_systems, max_age=60)
+    with mock.patch('pxe_manager.cobbler.time', return_value=1000):
+        index.get_ip('a-01.example.com')
+    with mock.patch('pxe_manager.cobbler.time', return_value=1030):
+        index.get_ip('a-01.example.com')
+    assert get_systems.call_count == 1
+    with mock.patch('pxe_manager.cobbler.time', return_value=1100):
+        index.get_ip('a-01.example.com')
+    assert get_systems.call_count == 2
+
+
+def test_index_unknown_host():
+    get_systems = mock.Mock(return_value=systems)
+    index = CobblerSystemIndex(get_systems)
+    index.refresh()
+    try:
+        index.get_ip('b-01.example.com')
+    except SystemNotFoundException:
+        pass
+    else:
+        raise AssertionError("Expected SystemNotFoundException")
+    # a miss rebuilds the index in case the system was just added
+    assert get_systems.call_count == 2
+
+
+def get_cobbler_client(proxy):
+    with mock.patch('pxe_manager.cobbler.xmlrpclib.ServerProxy', return_value=proxy):
+        client = CobblerClient('http://cobbler.example.com/cobbler_api', 'user', 'password')
+    client._local.proxy = proxy
+    return client
+
+
+def test_client_proxy_per_thread():
+    client = get_cobbler_client(mock.Mock())
+    proxies = []
+    with mock.patch('pxe_manager.cobbler.xmlrpclib.ServerProxy', side_effect=lambda url: object()):
+        thread = threading.Thread(target=lambda: proxies.append(client.proxy))
+        thread.start()
+        thread.join()
+    assert proxies[0] is not client.proxy
+
+
+def test_client_relogin_on_expired_token():
+    proxy = mock.Mock()
+    proxy.login.side_effect = ['token1', 'token2']
+    proxy.save_system.side_effect = [xmlrpclib.Fault(1, "<class 'cobbler.cexceptions.CX'>:'invalid token: token1'"),
+                                     True]
+    client = get_cobbler_client(proxy)
+    assert client.call_authenticated('save_system', 'handle') is True
+    proxy.save_system.assert_called_with('handle', 'token2')
+    assert client.token == 'token2'
+
+
+def test_client_batch_falls_back_without_multicall():
+    proxy = mock.Mock()
+    proxy.login.return_value = 'token'
+    proxy.modify_system.return_value = True
+    proxy.save_system.return_value = True
+    client = get_cobbler_client(proxy)
+    multicall = mock.Mock(side_effect=xmlrpclib.Fault(1, 'method "system.multicall" is not supported'))
+    with mock.patch('pxe_manager.cobbler.xmlrpclib.MultiCall', return_value=multicall):
+        results = client.batch([('modify_system', ('handle', 'profile', 'centos')), ('save_system', ('handle',))],
+                               authenticated=True)
+    assert results == [True, True]
+    assert not client.multicall_supported
+    proxy.modify_system.assert_called_with('handle', 'profile', 'centos', 'token')
+    proxy.save_system.assert_called_with('handle', 'token')
@@ -0,0 +1,25 @@
+from pxe_manager.ipalloc import IPRangeAllocator, to_ranges
+
+pool = ['10.111.1.%d' % i for i in [1, 2, 3, 4, 5, 6, 7, 8, 20, 21, 22, 40, 250, 251, 252, 253, 254, 255]] + \
+       ['10.111.2.0', '10.111.2.1']
+
+
+def test_to_ranges():
+    assert to_ranges(['10.111.1.3', '10.111.1.1', '10.111.1.2', '10.111.1.7']) == \
+        ['10.111.1.1-10.111.1.3', '10.111.1.7']
+    assert to_ranges(['10.111.1.255', '10.111.2.0']) == ['10.111.1.255-10.111.2.0']
+
+
+def test_allocate_best_fit_block():
+    allocator = IPRangeAllocator(pool)
+    assert allocator.allocate(3) == ['10.111.1.20', '10.111.1.21', '10.111.1.22']
+    assert allocator.allocate(1) == ['10.111.1.40']
+    assert allocator.allocate(8) == ['10.111.1.%d' % i for i in range(1, 9)]
+
+
+def test_allocate_across_runs():
+    allocator = IPRangeAllocator(pool)
+    block = allocator.allocate(12)
+    assert to_ranges(block) == ['10.111.1.1-10.111.1.8', '10.111.1.250-10.111.1.253']
+    assert len(allocator.allocate(100)) == len(pool) - 12
+    assert allocator.allocate(1) == []
@@ -0,0 +1,33 @@
+from pxe_manager.placement import BestFitPlacement, RandomPlacement
+
+GB = 1024 ** 3
+small = [{'hostname': 'b-0%d' % i, 'tags': {'memory': 16 * GB, 'cpucores': 4, 'cpumhz': 2200}} for i in range(4)]
+large = [{'hostname': 'a-0%d' % i, 'tags': {'memory': 128 * GB, 'cpucores': 16, 'cpumhz': 2600}} for i in range(2)]
+
+
+def test_best_fit_prefers_smallest_host():
+    ranked = BestFitPlacement().rank(large + small, {'cpucores': 4})
+    assert [host['hostname'][0] for host in ranked] == ['b'] * 4 + ['a'] * 2
+
+
+def test_best_fit_honours_memory_fudge():
+    # 15GB of reported memory satisfies a 16GB request
+    hosts = [{'hostname': 'c-01', 'tags': {'memory': 15 * GB}}, {'hostname': 'a-01', 'tags': {'memory': 128 * GB}}]
+    ranked = BestFitPlacement().rank(hosts, {'memory': 16 * GB})
+    assert ranked[0]['hostname'] == 'c-01'
+
+
+def test_best_fit_spreads_equal_hosts():
+    firsts = set(BestFitPlacement().rank(small)[0]['hostname'] for _ in range(50))
+    assert len(firsts) > 1
+
+
+def test_best_fit_tolerates_missing_and_odd_tags():
+    hosts = [{'hostname': 'd-01'}, {'hostname': 'd-02', 'tags': {'memory': 'lots'}}] + large
+    ranked = BestFitPlacement().rank(hosts, {})
+    assert sorted(host['hostname'] for host in ranked[:2]) == ['d-01', 'd-02']
+
+
+def test_random_placement_keeps_candidates():
+    ranked = RandomPlacement().rank(small + large, {'cpucores': 4})
+    assert sorted(host['hostname'] for host in ranked) == sorted(host['hostname'] for host in small + large)
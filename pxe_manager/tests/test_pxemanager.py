@@ -1,6 +1,11 @@
-from pxe_manager.pxemanager import PxeManager
+from pxe_manager.pxemanager import PxeManager, UnableToFullfillRequestException, FreeResourcesException
 from resource_manager.client import ResourceManagerClient
+import json
 import httpretty
+import mock
+import socket
+import threading
+import time
 
 
 @httpretty.activate
@@ -30,3 +35,330 @@ def test_defaults():
     pxe_manager = PxeManager(cobbler_url, cobbler_user, cobbler_password, host_client, pub_ip_client, priv_ip_client)
     for key, value in distro_map.iteritems():
         assert pxe_manager.distro[key] == value
+
+
+def get_pxe_manager():
+    with mock.patch('pxe_manager.pxemanager.CobblerClient'):
+        return PxeManager("http://cobbler.example.com/cobbler_api", "user", "password",
+                          mock.Mock(), mock.Mock(), mock.Mock())
+
+
+def test_claim_hosts_replaces_hosts_lost_to_other_reservations():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_manager.claim_resources.side_effect = [[{'hostname': 'a-01'}], [{'hostname': 'a-03'}]]
+    claimed = pxe_manager.claim_hosts(['a-01', 'a-02', 'a-03'], 2, 'tony', 'job-1')
+    assert claimed == ['a-01', 'a-03']
+    where = pxe_manager.host_manager.claim_resources.call_args[1]['where']
+    assert where == {'hostname': {'$in': ['a-03']}, 'state': 'idle'}
+
+
+def test_claim_hosts_releases_partial_claim():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_manager.claim_resources.return_value = [{'hostname': 'a-01'}]
+    try:
+        pxe_manager.claim_hosts(['a-01', 'a-02'], 2, 'tony', 'job-1')
+    except UnableToFullfillRequestException:
+        pass
+    else:
+        raise AssertionError("Expected UnableToFullfillRequestException")
+    pxe_manager.host_manager.update_resources.assert_called_once_with(
+        where={'hostname': {'$in': ['a-01']}}, changes={'owner': '', 'state': 'idle', 'job_id': ''})
+
+
+def test_make_ip_reservation_claims_on_server():
+    pxe_manager = get_pxe_manager()
+    ip_manager = pxe_manager.public_ip_manager
+    ip_manager.query_resources.return_value = [{'address': '10.0.0.%d' % i} for i in [1, 3, 4, 9]]
+    ip_manager.claim_resources.return_value = [{'address': '10.0.0.3'}, {'address': '10.0.0.4'}]
+    reservation = pxe_manager.make_ip_reservation('public', 'job-1', 2, tags={'subnet': 'a'})
+    assert reservation == ['10.0.0.3', '10.0.0.4']
+    assert pxe_manager.get_ip_reservation_as_ranges('public') == ['10.0.0.3-10.0.0.4']
+    ip_manager.query_resources.assert_called_once_with(where={'owner': '', 'tags.subnet': 'a'}, fields=['address'])
+    ip_manager.claim_resources.assert_called_once_with(
+        where={'owner': '', 'tags.subnet': 'a', 'address': {'$in': ['10.0.0.3', '10.0.0.4']}}, count=2,
+        changes={'owner': 'job-1'})
+
+
+def test_make_ip_reservation_of_nothing():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.public_ip_reservation.append('10.111.1.1')
+    assert pxe_manager.make_ip_reservation('public', 'job-1', 0) == ['10.111.1.1']
+    assert not pxe_manager.public_ip_manager.query_resources.called
+    assert not pxe_manager.public_ip_manager.claim_resources.called
+
+
+def test_make_ip_reservation_replaces_lost_addresses():
+    pxe_manager = get_pxe_manager()
+    ip_manager = pxe_manager.public_ip_manager
+    ip_manager.query_resources.side_effect = [[{'address': '10.0.0.%d' % i} for i in [1, 2, 7]],
+                                              [{'address': '10.0.0.7'}]]
+    ip_manager.claim_resources.side_effect = [[{'address': '10.0.0.1'}], [{'address': '10.0.0.7'}]]
+    assert pxe_manager.make_ip_reservation('public', 'job-1', 2) == ['10.0.0.1', '10.0.0.7']
+    assert ip_manager.claim_resources.call_args[1]['where']['address'] == {'$in': ['10.0.0.7']}
+
+
+def test_provision_hosts_in_parallel():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.parallelism = 3
+    pxe_manager.kickstart_machines = mock.Mock(return_value=('task-1', 'complete'))
+    threads = set()
+
+    def preflight_host(hostname):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.1)
+        return hostname != 'a-02'
+
+    pxe_manager.preflight_host = preflight_host
+    assert pxe_manager.provision_hosts(['a-01', 'a-02', 'a-03'], 'centos') == ['a-02']
+    assert len(threads) == 3
+    pxe_manager.kickstart_machines.assert_called_once_with(['a-01', 'a-03'], 'centos')
+
+
+def test_kickstart_machines_batches_edits_and_power():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.systems = mock.Mock()
+    pxe_manager.systems.get_system_name.side_effect = lambda hostname: hostname.split('.')[0]
+    pxe_manager.cobbler.batch.side_effect = [['handle-1', 'handle-2'], [True] * 6]
+    pxe_manager.cobbler.call_authenticated.return_value = 'task-1'
+    pxe_manager.cobbler.get_task_status.return_value = [0, 'reboot', 'complete', []]
+    task_id, state = pxe_manager.kickstart_machines(['a-01.example.com', 'a-02.example.com'], 'centos')
+    assert (task_id, state) == ('task-1', 'complete')
+    edits = pxe_manager.cobbler.batch.call_args_list[1][0][0]
+    assert edits[3] == ('modify_system', ('handle-2', 'profile', 'centos7-x86_64-raid0'))
+    pxe_manager.cobbler.call_authenticated.assert_called_once_with(
+        'background_power_system', {'power': 'reboot', 'systems': ['a-01', 'a-02']})
+    assert set(pxe_manager.kickstart_times) == set(['a-01.example.com', 'a-02.example.com'])
+
+
+def test_wait_for_hosts_replaces_failed_host():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.boot_wait = 0
+    pxe_manager.host_reservation = ['a-01', 'a-02']
+    pxe_manager.is_system_ready = lambda system_name: system_name != 'a-02'
+
+    def replace():
+        pxe_manager.host_reservation.append('a-03')
+        return ['a-03']
+
+    pxe_manager.wait_for_hosts(['a-01', 'a-02'], replace)
+    assert pxe_manager.host_reservation == ['a-01', 'a-03']
+
+
+def test_wait_for_hosts_releases_surplus_hosts():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.boot_wait = 0
+    pxe_manager.host_reservation = ['a-01', 'a-02', 'a-03', 'a-04']
+    slow = threading.Event()
+
+    def is_system_ready(system_name):
+        if system_name == 'a-04':
+            slow.wait(5)
+        return system_name != 'a-02'
+
+    pxe_manager.is_system_ready = is_system_ready
+    pxe_manager.host_manager.update_resources.return_value = [{'hostname': 'a-04', '_status': 'OK'}]
+    replace = mock.Mock()
+    kept = pxe_manager.wait_for_hosts(['a-01', 'a-02', 'a-03', 'a-04'], replace, needed=2)
+    assert sorted(kept) == ['a-01', 'a-03']
+    # a-04 is still being checked but already out of the reservation
+    assert sorted(pxe_manager.host_reservation) == ['a-01', 'a-03']
+    assert not replace.called
+    slow.set()
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join(5)
+    pxe_manager.host_manager.update_resources.assert_called_once_with(
+        where={'hostname': {'$in': ['a-04']}}, changes={'owner': '', 'state': 'idle', 'job_id': ''})
+    assert pxe_manager.host_reservation == ['a-01', 'a-03']
+
+
+def test_wait_for_hosts_marks_crashed_check_failed():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.boot_wait = 0
+    pxe_manager.host_reservation = ['a-01', 'a-02']
+
+    def is_system_ready(system_name):
+        if system_name == 'a-02':
+            raise IOError('connection reset')
+        return True
+
+    pxe_manager.is_system_ready = is_system_ready
+    pxe_manager.wait_for_hosts(['a-01', 'a-02'], mock.Mock(return_value=[]), needed=1)
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join(5)
+    pxe_manager.host_manager.update_resource.assert_called_once_with(
+        json.dumps({'hostname': 'a-02', 'owner': '', 'state': 'pxe_failed', 'job_id': ''}))
+    assert pxe_manager.host_reservation == ['a-01']
+
+
+def test_wait_for_hosts_waits_for_checks_when_replace_fails():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.boot_wait = 0
+    pxe_manager.host_reservation = ['a-01', 'a-02']
+    checked = []
+
+    def is_system_ready(system_name):
+        if system_name == 'a-02':
+            time.sleep(.2)
+        checked.append(system_name)
+        return system_name == 'a-02'
+
+    pxe_manager.is_system_ready = is_system_ready
+    try:
+        pxe_manager.wait_for_hosts(['a-01', 'a-02'], mock.Mock(side_effect=UnableToFullfillRequestException()))
+    except UnableToFullfillRequestException:
+        pass
+    else:
+        raise AssertionError("Expected UnableToFullfillRequestException")
+    assert sorted(checked) == ['a-01', 'a-02']
+
+
+def test_check_ssh_probes_before_login():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.ssh = mock.Mock()
+    probes = [False, False, False, True]
+    delays = []
+    with mock.patch('pxe_manager.pxemanager.port_open', side_effect=lambda ip, timeout: probes.pop(0)), \
+            mock.patch('pxe_manager.pxemanager.sleep', side_effect=delays.append):
+        assert pxe_manager.check_ssh('10.0.0.1', interval=4, min_backoff=1)
+    pxe_manager.ssh.connect.assert_called_once_with('10.0.0.1')
+    assert len(delays) == 3
+    assert delays[0] == 1 and delays[1] <= 2 and delays[2] <= 4
+
+
+def test_check_ssh_gives_up():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.ssh = mock.Mock()
+    with mock.patch('pxe_manager.pxemanager.port_open', return_value=False), \
+            mock.patch('pxe_manager.pxemanager.sleep'), \
+            mock.patch('pxe_manager.pxemanager.time', side_effect=[0, 10, 20, 30]):
+        assert not pxe_manager.check_ssh('10.0.0.1', interval=10, retries=3)
+    assert not pxe_manager.ssh.connect.called
+
+
+def test_filter_hosts_by_tags():
+    pxe_manager = get_pxe_manager()
+    hosts = [{'_id': '1', '_etag': 'x', 'hostname': 'a-01', 'tags': {'memory': 67258503167, 'cpucores': 8}},
+             {'_id': '2', '_etag': 'y', 'hostname': 'b-01', 'tags': {'memory': 17179869184, 'cpucores': 4}}]
+    matches = pxe_manager.filter_hosts_by_tags(hosts, {'memory': 68719476736, 'cpucores': 4})
+    assert [host['hostname'] for host in matches] == ['a-01']
+    matches = pxe_manager.filter_resources_by_tags(hosts, {'cpucores': 4})
+    assert [host['hostname'] for host in matches] == ['b-01']
+
+
+def test_is_system_ready_emits_phases():
+    pxe_manager = get_pxe_manager()
+    sink = mock.Mock()
+    pxe_manager.timer.sinks = [sink]
+    pxe_manager.systems = mock.Mock()
+    pxe_manager.ssh = mock.Mock()
+    pxe_manager.check_ssh = mock.Mock(return_value=True)
+    pxe_manager.check_for_file_on_target = mock.Mock(return_value=False)
+    pxe_manager.host_jobs['a-01'] = 'job-1'
+    assert pxe_manager.is_system_ready('a-01')
+    events = [call[0][0] for call in sink.emit.call_args_list]
+    assert [(event['name'], event['host'], event['job_id']) for event in events] == \
+        [('ssh_wait', 'a-01', 'job-1'), ('kickstart_check', 'a-01', 'job-1')]
+
+
+def test_for_reservation_shares_clients():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_reservation.append('a-01')
+    manager = pxe_manager.for_reservation()
+    assert manager.host_reservation == []
+    assert manager.cobbler is pxe_manager.cobbler and manager.ssh is pxe_manager.ssh
+    assert manager.host_jobs is not pxe_manager.host_jobs
+    assert manager.kickstart_times is not pxe_manager.kickstart_times
+
+
+def test_reservation_served_from_warm_pool():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_manager.query_resources.return_value = [{'hostname': 'a-01', 'tags': {'cpucores': 8}},
+                                                             {'hostname': 'a-02', 'tags': {'cpucores': 2}}]
+    pxe_manager.host_manager.claim_resources.return_value = [{'hostname': 'a-01'}]
+    pxe_manager.reserve_and_provision_hosts = mock.Mock()
+    pxe_manager.systems = mock.Mock()
+    with mock.patch('pxe_manager.pxemanager.port_open', return_value=True):
+        pxe_manager.make_host_reservation('tony', 1, 'job-1', 'centos', tags={'cpucores': 4})
+    pxe_manager.host_manager.claim_resources.assert_called_once_with(
+        where={'hostname': {'$in': ['a-01']}, 'state': 'ready', 'distro': 'centos'}, count=1,
+        changes={'owner': 'tony', 'state': 'in_use', 'job_id': 'job-1', 'distro': ''})
+    assert pxe_manager.host_reservation == ['a-01']
+    assert not pxe_manager.reserve_and_provision_hosts.called
+
+
+def test_spares_fall_back_only_on_initial_claim():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.reserve_hosts = mock.Mock(side_effect=[UnableToFullfillRequestException(), ['a-01', 'a-02'],
+                                                       UnableToFullfillRequestException()])
+    pxe_manager.provision_hosts = mock.Mock(return_value=['a-02'])
+    try:
+        pxe_manager.reserve_and_provision_hosts('tony', 2, 'job-1', 'centos', spares=1)
+    except UnableToFullfillRequestException:
+        pass
+    else:
+        raise AssertionError("Expected UnableToFullfillRequestException")
+    assert [call[1]['count'] for call in pxe_manager.reserve_hosts.call_args_list] == [3, 2, 1]
+
+
+def test_failed_spare_replacement_is_best_effort():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.reserve_hosts = mock.Mock(side_effect=[['a-01', 'a-02', 'a-03'], UnableToFullfillRequestException()])
+    pxe_manager.provision_hosts = mock.Mock(return_value=['a-03'])
+    assert pxe_manager.reserve_and_provision_hosts('tony', 2, 'job-1', 'centos', spares=1) == ['a-01', 'a-02']
+
+
+def test_check_ssh_backs_off_failed_logins():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.ssh = mock.Mock()
+    pxe_manager.ssh.connect.side_effect = [socket.error()] * 4 + [None]
+    delays = []
+    with mock.patch('pxe_manager.pxemanager.port_open', return_value=True), \
+            mock.patch('pxe_manager.pxemanager.random.uniform', side_effect=lambda low, high: high), \
+            mock.patch('pxe_manager.pxemanager.sleep', side_effect=delays.append):
+        assert pxe_manager.check_ssh('10.0.0.1', interval=8, min_backoff=1)
+    assert delays == [1, 2, 4, 8]
+
+
+def test_free_machines_reports_failures():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_manager.update_resources.return_value = [
+        {'hostname': 'a-01', '_status': 'OK'},
+        {'hostname': 'a-02', '_status': 'ERR', '_issues': {'_etag': 'document changed during the update'}}]
+    try:
+        pxe_manager.free_machines('job_id', 'job-1')
+    except FreeResourcesException as e:
+        assert [failure['hostname'] for failure in e.failures] == ['a-02']
+        assert 'a-02' in str(e)
+    else:
+        raise AssertionError("Expected FreeResourcesException")
+
+
+def test_failed_power_task_fails_batch():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.systems = mock.Mock()
+    pxe_manager.cobbler.batch.side_effect = [['handle-1'], [True] * 3]
+    pxe_manager.cobbler.call_authenticated.return_value = 'task-1'
+    pxe_manager.cobbler.get_task_status.return_value = [0, 'reboot', 'failed', []]
+    pxe_manager.host_reservation = ['a-01']
+    pxe_manager.preflight_host = lambda hostname: True
+    assert pxe_manager.provision_hosts(['a-01'], 'centos') == ['a-01']
+    assert pxe_manager.host_reservation == []
+    state = json.loads(pxe_manager.host_manager.update_resource.call_args[0][0])['state']
+    assert state == 'pxe_failed'
+
+
+def test_dead_ready_host_is_replaced():
+    pxe_manager = get_pxe_manager()
+    pxe_manager.host_manager.query_resources.return_value = [{'hostname': 'a-01', 'tags': {}},
+                                                             {'hostname': 'a-02', 'tags': {}}]
+    pxe_manager.host_manager.claim_resources.side_effect = lambda where, count, changes: [
+        {'hostname': hostname} for hostname in where['hostname']['$in']]
+    pxe_manager.systems = mock.Mock()
+    pxe_manager.systems.get_ip.side_effect = lambda hostname: hostname
+    with mock.patch('pxe_manager.pxemanager.port_open', side_effect=lambda ip: ip != 'a-01'), \
+            mock.patch.object(pxe_manager.placement, 'rank', side_effect=lambda resources, tags: resources):
+        assert pxe_manager.take_ready_hosts('tony', 1, 'job-1', 'centos') == ['a-02']
+    state = json.loads(pxe_manager.host_manager.update_resource.call_args[0][0])
+    assert state['hostname'] == 'a-01' and state['state'] == 'needs_repair'
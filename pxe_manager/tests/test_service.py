@@ -0,0 +1,119 @@
+import json
+import mock
+
+from pxe_manager.pxemanager import UnableToFullfillRequestException
+from pxe_manager.service import ReservationService, create_app
+
+
+def get_service(make_host_reservation):
+    pxe_manager = mock.Mock()
+    pxe_manager.distro = {'centos': 'centos7-x86_64-raid0'}
+
+    def for_reservation():
+        manager = mock.Mock()
+        manager.host_reservation = []
+
+        def reserve(owner, count, job_id, distro, tags, spares):
+            make_host_reservation(manager, count)
+
+        manager.make_host_reservation.side_effect = reserve
+        return manager
+
+    pxe_manager.for_reservation.side_effect = for_reservation
+    service = ReservationService(pxe_manager, workers=2)
+    service.start()
+    return service
+
+
+def test_reservations_run_in_background():
+    def reserve(manager, count):
+        manager.host_reservation.extend('a-0%d' % i for i in range(count))
+
+    service = get_service(reserve)
+    tickets = [service.submit('tony', count, 'job-%d' % count, 'centos') for count in (1, 2, 3)]
+    for ticket in tickets:
+        assert ticket.wait(5)
+    service.stop()
+    assert [ticket.state for ticket in tickets] == ['done'] * 3
+    assert tickets[2].hosts == ['a-00', 'a-01', 'a-02']
+    assert service.get(tickets[0].id) is tickets[0]
+
+
+def test_failed_reservation_frees_its_machines():
+    managers = []
+
+    def reserve(manager, count):
+        managers.append(manager)
+        manager.host_reservation.append('a-01')
+        raise UnableToFullfillRequestException()
+
+    service = get_service(reserve)
+    ticket = service.submit('tony', 1, 'job-1', 'centos')
+    assert ticket.wait(5)
+    service.stop()
+    assert ticket.state == 'failed'
+    managers[0].release_hosts.assert_called_once_with(['a-01'])
+    assert not managers[0].free_machines.called
+
+
+def test_failed_release_still_fails_the_ticket():
+    def reserve(manager, count):
+        manager.host_reservation.append('a-01')
+        manager.release_hosts.side_effect = IOError('connection reset')
+        raise UnableToFullfillRequestException()
+
+    service = get_service(reserve)
+    # more tickets than workers, they all finish only if the workers survive
+    tickets = [service.submit('tony', 1, 'job-%d' % i, 'centos') for i in range(3)]
+    for ticket in tickets:
+        assert ticket.wait(5)
+    service.stop()
+    assert [ticket.state for ticket in tickets] == ['failed'] * 3
+    assert 'connection reset' in tickets[0].error
+
+
+def test_worker_survives_unexpected_errors():
+    service = get_service(lambda manager, count: None)
+    service.warm_pool = mock.Mock()
+    service.warm_pool.notify.side_effect = IOError('connection reset')
+    tickets = [service.submit('tony', 1, 'job-%d' % i, 'centos') for i in range(3)]
+    for ticket in tickets:
+        assert ticket.wait(5)
+    service.stop()
+    assert [ticket.state for ticket in tickets] == ['done'] * 3
+
+
+def test_submit_requires_owner_and_job_id():
+    service = get_service(lambda manager, count: None)
+    for owner, job_id in (('tony', None), ('tony', ''), (None, 'job-1')):
+        try:
+            service.submit(owner, 1, job_id, 'centos')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected ValueError")
+    service.stop()
+
+
+def test_stop_fails_queued_reservations():
+    service = ReservationService(mock.Mock(distro={'centos': 'centos7-x86_64-raid0'}), workers=1)
+    ticket = service.submit('tony', 1, 'job-1', 'centos')
+    service.stop()
+    assert ticket.state == 'failed'
+
+
+def test_http_interface():
+    service = get_service(lambda manager, count: manager.host_reservation.append('a-01'))
+    client = create_app(service).test_client()
+    response = client.post('/reservations', data=json.dumps({'owner': 'tony', 'count': 1, 'job_id': 'job-1',
+                                                             'distro': 'centos'}))
+    assert response.status_code == 202
+    ticket_id = json.loads(response.data)['id']
+    ticket = json.loads(client.get('/reservations/' + ticket_id + '?wait=5').data)
+    service.stop()
+    assert ticket['state'] == 'done'
+    assert ticket['hosts'] == ['a-01']
+    assert client.get('/reservations/nothing').status_code == 404
+    response = client.post('/reservations', data=json.dumps({'owner': 'tony', 'count': 1, 'job_id': 'job-1',
+                                                             'distro': 'windows'}))
+    assert response.status_code == 400
@@ -0,0 +1,68 @@
+import mock
+import socket
+
+from pxe_manager.ssh import SSHSessionManager, port_open
+
+
+def get_client():
+    client = mock.Mock()
+    client.get_transport.return_value.is_active.return_value = True
+    stdout = mock.Mock()
+    stdout.read.return_value = 'OK\n'
+    stdout.channel.recv_exit_status.return_value = 0
+    client.exec_command.return_value = (None, stdout, None)
+    return client
+
+
+@mock.patch('pxe_manager.ssh.SSHClient')
+def test_commands_share_a_session(ssh_client):
+    ssh_client.side_effect = get_client
+    sessions = SSHSessionManager('root', 'foobar')
+    assert sessions.run('10.0.0.1', 'touch kickstart.check') == (0, 'OK\n')
+    assert sessions.run('10.0.0.1', 'ls') == (0, 'OK\n')
+    assert ssh_client.call_count == 1
+    client = sessions.sessions['10.0.0.1']
+    sessions.close_all()
+    client.close.assert_called_once_with()
+
+
+@mock.patch('pxe_manager.ssh.SSHClient')
+def test_dead_session_reconnects(ssh_client):
+    ssh_client.side_effect = get_client
+    sessions = SSHSessionManager('root', 'foobar')
+    sessions.get('10.0.0.1').get_transport.return_value.is_active.return_value = False
+    sessions.run('10.0.0.1', 'ls')
+    assert ssh_client.call_count == 2
+
+
+@mock.patch('pxe_manager.ssh.SSHClient')
+def test_sessions_are_bounded(ssh_client):
+    ssh_client.side_effect = get_client
+    sessions = SSHSessionManager('root', 'foobar', max_sessions=2)
+    first = sessions.get('10.0.0.1')
+    sessions.get('10.0.0.2')
+    sessions.get('10.0.0.3')
+    assert sorted(sessions.sessions) == ['10.0.0.2', '10.0.0.3']
+    first.close.assert_called_once_with()
+
+
+@mock.patch('pxe_manager.ssh.SSHClient')
+def test_failed_connect_is_closed(ssh_client):
+    client = get_client()
+    client.connect.side_effect = IOError()
+    ssh_client.return_value = client
+    sessions = SSHSessionManager('root', 'foobar')
+    try:
+        sessions.connect('10.0.0.1')
+    except IOError:
+        pass
+    client.close.assert_called_once_with()
+    assert sessions.sessions == {}
+
+
+def test_port_open():
+    with mock.patch('pxe_manager.ssh.socket.create_connection') as create_connection:
+        assert port_open('10.0.0.1')
+        create_connection.assert_called_once_with(('10.0.0.1', 22), 3)
+        create_connection.side_effect = socket.timeout()
+        assert not port_open('10.0.0.1')
@@ -0,0 +1,34 @@
+from pxe_manager.tagindex import TagIndex
+
+GB = 1024 ** 3
+hosts = [{'hostname': 'a-01', 'tags': {'memory': 67258503167, 'cpucores': 8, 'model': 'r720'}},
+         {'hostname': 'b-01', 'tags': {'memory': 16 * GB, 'cpucores': 4, 'model': 'r410'}},
+         {'hostname': 'b-02', 'tags': {'memory': 16 * GB, 'cpucores': 4, 'model': 'r410', 'disks': ['sda']}},
+         {'hostname': 'c-01', 'tags': {'cpucores': 2}}]
+
+
+def hostnames(resources):
+    return [resource['hostname'] for resource in resources]
+
+
+def test_ranges_and_equality():
+    index = TagIndex(hosts)
+    assert hostnames(index.match({'cpucores': 4})) == ['a-01', 'b-01', 'b-02']
+    assert hostnames(index.match({'cpucores': 4, 'model': 'r410'})) == ['b-01', 'b-02']
+    assert hostnames(index.match({'model': 'r610'})) == []
+    assert hostnames(index.match({})) == hostnames(hosts)
+
+
+def test_memory_fudge():
+    # 67258503167 bytes is just under 64GB
+    assert hostnames(TagIndex(hosts).match({'memory': 64 * GB})) == ['a-01']
+
+
+def test_exact_match():
+    assert hostnames(TagIndex(hosts).match({'cpucores': 4}, ranges=False)) == ['b-01', 'b-02']
+
+
+def test_unhashable_values():
+    index = TagIndex(hosts)
+    assert hostnames(index.match({'disks': ['sda']})) == ['b-02']
+    assert hostnames(index.match({'disks': ['sdb']})) == []
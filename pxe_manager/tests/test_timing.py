@@ -0,0 +1,57 @@
+import json
+import mock
+import os
+import tempfile
+
+from pxe_manager.timing import JsonFileSink, StatsdSink, Timer
+
+
+def test_phase_events():
+    sink = mock.Mock()
+    timer = Timer([sink])
+    with timer.phase('preflight', host='a-01', job_id='job-1'):
+        pass
+    with timer.phase('kickstart_check', host='a-01', job_id='job-1') as event:
+        event['status'] = 'failed'
+    try:
+        with timer.phase('claim_hosts', job_id='job-1'):
+            raise ValueError()
+    except ValueError:
+        pass
+    events = [call[0][0] for call in sink.emit.call_args_list]
+    assert [(event['name'], event['status']) for event in events] == \
+        [('preflight', 'ok'), ('kickstart_check', 'failed'), ('claim_hosts', 'error')]
+    assert events[0]['host'] == 'a-01' and events[0]['job_id'] == 'job-1'
+    assert events[0]['duration'] >= 0
+
+
+def test_broken_sink_is_ignored():
+    sink = mock.Mock()
+    sink.emit.side_effect = IOError()
+    with Timer([sink]).phase('preflight'):
+        pass
+    Timer([sink]).count('hosts_released', host='a-01')
+    assert sink.emit.call_count == 2
+
+
+def test_json_file_sink():
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        timer = Timer([JsonFileSink(path)])
+        timer.count('hosts_released', host='a-01', job_id='job-1')
+        timer.count('hosts_released', host='a-02', job_id='job-1')
+        with open(path) as events:
+            lines = [json.loads(line) for line in events]
+        assert [line['host'] for line in lines] == ['a-01', 'a-02']
+    finally:
+        os.remove(path)
+
+
+def test_statsd_sink():
+    sink = StatsdSink('127.0.0.1')
+    sink.socket = mock.Mock()
+    sink.emit({'type': 'timing', 'name': 'preflight', 'status': 'ok', 'duration': 1.5})
+    sink.emit({'type': 'counter', 'name': 'hosts_released', 'value': 2})
+    assert [call[0][0] for call in sink.socket.sendto.call_args_list] == \
+        ['pxe_manager.preflight.ok:1500|ms', 'pxe_manager.hosts_released:2|c']
@@ -0,0 +1,52 @@
+import mock
+
+from pxe_manager.pxemanager import UnableToFullfillRequestException
+from pxe_manager.warmpool import WarmPool
+
+
+def get_pool(targets, ready):
+    pxe_manager = mock.Mock()
+    pxe_manager.distro = {'centos': 'centos7-x86_64-raid0', 'rhel': 'rhel7-x86_64-raid0'}
+    pxe_manager.host_manager.count_resources.return_value = ready
+    manager = pxe_manager.for_reservation.return_value
+    manager.host_reservation = []
+    return WarmPool(pxe_manager, targets), manager
+
+
+def test_replenish_tops_up_pool():
+    pool, manager = get_pool({'centos': 3}, ready=1)
+    manager.make_host_reservation.side_effect = lambda **kwargs: manager.host_reservation.extend(['a-01', 'a-02'])
+    assert pool.replenish('centos') == ['a-01', 'a-02']
+    kwargs = manager.make_host_reservation.call_args[1]
+    assert kwargs['count'] == 2 and kwargs['distro'] == 'centos' and not kwargs['use_ready']
+    changes = manager.host_manager.update_resources.call_args[1]['changes']
+    assert changes == {'owner': '', 'state': 'ready', 'job_id': '', 'distro': 'centos'}
+
+
+def test_full_pool_is_left_alone():
+    pool, manager = get_pool({'centos': 2}, ready=2)
+    assert pool.replenish('centos') == []
+    assert not manager.make_host_reservation.called
+
+
+def test_replenish_without_free_hosts():
+    pool, manager = get_pool({'centos': 2}, ready=0)
+    manager.make_host_reservation.side_effect = UnableToFullfillRequestException()
+    assert pool.replenish('centos') == []
+    assert manager.free_machines.call_args[1]['field'] == 'job_id'
+
+
+def test_unknown_distro():
+    try:
+        get_pool({'windows': 1}, ready=0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+
+
+def test_drain_clears_distro():
+    pool, _ = get_pool({'centos': 2}, ready=2)
+    pool.drain('centos')
+    pool.pxe_manager.host_manager.update_resources.assert_called_once_with(
+        where={'state': 'ready', 'distro': 'centos'}, changes={'state': 'idle', 'distro': ''})
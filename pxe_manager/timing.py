@@ -0,0 +1,145 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import json
+import socket
+import threading
+
+from contextlib import contextmanager
+from time import time
+
+
+class PrintSink(object):
+    """
+    Print every event as a single JSON line, next to the rest of the PxeManager output.
+    """
+    def emit(self, event):
+        print "TIMING: " + json.dumps(event, sort_keys=True)
+
+
+class JsonFileSink(object):
+    def __init__(self, path):
+        """
+        Append every event to a file, one JSON document per line.
+
+        :param path: (string) path of the file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.path, 'a') as events:
+                events.write(line)
+
+
+class StatsdSink(object):
+    def __init__(self, host, port=8125, prefix='pxe_manager'):
+        """
+        Send every event to a statsd server, timings as <prefix>.<name>.<status> timers in milliseconds and counters
+        as <prefix>.<name> counters. Host and job tags are dropped since they would make a metric per host.
+
+        :param host: (string) statsd host
+        :param port: (int) statsd port
+        :param prefix: (string) prefix of the metric names
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, event):
+        if event['type'] == 'timing':
+            metric = "{0}.{1}.{2}:{3}|ms".format(self.prefix, event['name'], event['status'],
+                                                 int(event['duration'] * 1000))
+        else:
+            metric = "{0}.{1}:{2}|c".format(self.prefix, event['name'], event['value'])
+        try:
+            self.socket.sendto(metric, self.address)
+        except socket.error:
+            # metrics are best effort
+            pass
+
+
+class Timer(object):
+    def __init__(self, sinks=None):
+        """
+        Emit timing and counter events to a list of sinks. A sink is any object with an emit(event) method, event
+        being a JSON serializable dict.
+
+        :param sinks: list of sinks, events are dropped if there are none
+        """
+        self.sinks = sinks or []
+
+    def emit(self, event):
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception as e:
+                print "ERROR: could not emit timing event:", e
+
+    @contextmanager
+    def phase(self, name, **tags):
+        """
+        Time a block of code:
+
+            with timer.phase('preflight', host=hostname) as event:
+                ...
+                event['status'] = 'failed'
+
+        The event is emitted when the block exits, with status "ok" unless the block changed it or raised.
+
+        :param name: (string) name of the phase
+        :param tags: tags of the event, usually host and job_id
+        """
+        event = {'type': 'timing', 'name': name, 'start': time(), 'status': 'ok'}
+        event.update(tags)
+        try:
+            yield event
+        except Exception:
+            event['status'] = 'error'
+            raise
+        finally:
+            event['duration'] = round(time() - event['start'], 3)
+            if self.sinks:
+                self.emit(event)
+
+    def count(self, name, value=1, **tags):
+        """
+        Emit a counter event.
+
+        :param name: (string) name of the counter
+        :param value: (int) increment
+        :param tags: tags of the event, usually host and job_id
+        """
+        if self.sinks:
+            event = {'type': 'counter', 'name': name, 'value': value, 'start': time()}
+            event.update(tags)
+            self.emit(event)
@@ -0,0 +1,132 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+# Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+import threading
+import traceback
+import uuid
+
+from pxe_manager.pxemanager import UnableToFullfillRequestException
+
+
+class WarmPool(object):
+    def __init__(self, pxe_manager, targets, interval=60, owner='warm-pool'):
+        """
+        Keep a number of hosts per distro kickstarted and verified ahead of time, in the "ready" state, so
+        reservations for these distros are served without waiting for an install (see
+        PxeManager.take_ready_hosts). Each distro is replenished by its own background thread every interval
+        seconds, or right away when notify() is called after hosts were taken.
+
+        :param pxe_manager: (PxeManager) manager the hosts are kickstarted with
+        :param targets: (dict) distro key (see PxeManager.distro) -> number of hosts to keep ready
+        :param interval: (int) seconds between checks of the pool size
+        :param owner: owner of the hosts while they are being kickstarted for the pool
+        """
+        for distro in targets:
+            if distro not in pxe_manager.distro:
+                raise ValueError('Unknown distro "{0}"'.format(distro))
+        self.pxe_manager = pxe_manager
+        self.targets = targets
+        self.interval = interval
+        self.owner = owner
+        self._wakeups = dict((distro, threading.Event()) for distro in targets)
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for distro in self.targets:
+            thread = threading.Thread(target=self._run, args=(distro,), name='warm-pool-' + distro)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stop replenishing. A replenishment in progress is finished first.
+        """
+        self._stopped.set()
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def notify(self, distro):
+        """
+        Replenish the pool of a distro now, ex: after a reservation took hosts from it.
+        """
+        if distro in self._wakeups:
+            self._wakeups[distro].set()
+
+    def _run(self, distro):
+        while not self._stopped.is_set():
+            try:
+                self.replenish(distro)
+            except Exception:
+                traceback.print_exc()
+            self._wakeups[distro].wait(self.interval)
+            self._wakeups[distro].clear()
+
+    def ready_count(self, distro):
+        return self.pxe_manager.host_manager.count_resources(where={'state': 'ready', 'distro': distro})
+
+    def replenish(self, distro):
+        """
+        Kickstart enough hosts with distro to bring its pool back to its target, and move them to "ready" once they
+        pass the readiness checks.
+
+        :return: list of the hosts added to the pool
+        """
+        missing = self.targets[distro] - self.ready_count(distro)
+        if missing <= 0:
+            return []
+        print "INFO: warming", missing, "host(s) with", distro
+        manager = self.pxe_manager.for_reservation()
+        job_id = 'warm-pool-{0}-{1}'.format(distro, uuid.uuid4().hex[:8])
+        try:
+            manager.make_host_reservation(owner=self.owner, count=missing, job_id=job_id, distro=distro, tags={},
+                                          use_ready=False)
+        except UnableToFullfillRequestException:
+            print "INFO: not enough free hosts to warm", missing, "host(s) with", distro
+            manager.free_machines(field='job_id', value=job_id)
+            return []
+        hosts = list(manager.host_reservation)
+        if hosts:
+            manager.host_manager.update_resources(where={'hostname': {'$in': hosts}, 'job_id': job_id},
+                                                  changes={'owner': '', 'state': 'ready', 'job_id': '',
+                                                           'distro': distro})
+        return hosts
+
+    def drain(self, distro):
+        """
+        Give the ready hosts of a distro back to the idle pool, ex: after lowering its target.
+        """
+        host_manager = self.pxe_manager.host_manager
+        return host_manager.update_resources(where={'state': 'ready', 'distro': distro},
+                                             changes={'state': 'idle', 'distro': ''})
@@ -1,6 +1,10 @@
 RESOURCE_METHODS = ['GET', 'POST', 'DELETE']
 ITEM_METHODS = ['GET', 'PATCH', 'PUT', 'DELETE']
-PAGINATION = False
+PAGINATION = True
+# Clients page through collections with max_results, the large default keeps
+# consumers that still expect the whole collection in one response working.
+PAGINATION_LIMIT = 1000
+PAGINATION_DEFAULT = 1000
 lookup_url = 'regex("[\.\w-]+")'
 
 
@@ -17,11 +21,15 @@ class ResourceSchema(object):
         'state': {
             'type': 'string',
             'required': True,
-            'allowed': ["pxe", "pxe_failed", "idle", "in_use", "needs_repair"]
+            'allowed': ["pxe", "pxe_failed", "idle", "in_use", "needs_repair", "ready"]
         },
         'job_id': {
             'type': 'string'
         },
+        # distro a "ready" machine was kickstarted with, see pxe_manager/warmpool.py
+        'distro': {
+            'type': 'string'
+        },
         'tags': {
             'type': 'dict'
         }
@@ -41,13 +49,69 @@ class ResourceSchema(object):
         }
     }
 
+    # A block of addresses stored as a list of sub-ranges, each free
+    # (owner "") or reserved by an owner. Reservations split the free
+    # sub-ranges and releasing merges them back, see bulk.py.
+    address_range_schema = {
+        'block': {
+            'type': 'string',
+            'required': True,
+            'unique': True
+        },
+        'ranges': {
+            'type': 'list',
+            'required': True,
+            'schema': {
+                'type': 'dict',
+                'schema': {
+                    'first': {
+                        'type': 'string',
+                        'required': True
+                    },
+                    'last': {
+                        'type': 'string',
+                        'required': True
+                    },
+                    'owner': {
+                        'type': 'string'
+                    }
+                }
+            }
+        },
+        'tags': {
+            'type': 'dict'
+        }
+    }
+
+    # Created by Eve at startup. Keep these in line with the queries in
+    # index-usage.py, which reports whether they are actually used.
+    machine_indexes = {
+        'state': [('state', 1)],
+        'state_memory': [('state', 1), ('tags.memory', 1)],
+        'state_distro': [('state', 1), ('distro', 1)],
+        'owner_job_id': [('owner', 1), ('job_id', 1)],
+        'job_id': [('job_id', 1)],
+        'updated': [('_updated', 1)]
+    }
+
+    address_indexes = {
+        'owner': [('owner', 1)],
+        'updated': [('_updated', 1)]
+    }
+
+    address_range_indexes = {
+        'owner': [('ranges.owner', 1)],
+        'updated': [('_updated', 1)]
+    }
+
     machines = {
         'item_title': 'machine',
         'additional_lookup': {
             'url': lookup_url,
             'field': 'hostname'
         },
-        'schema': machine_schema
+        'schema': machine_schema,
+        'mongo_indexes': machine_indexes
     }
 
     public_addresses = {
@@ -56,7 +120,8 @@ class ResourceSchema(object):
             'url': lookup_url,
             'field': 'address'
         },
-        'schema': address_schema
+        'schema': address_schema,
+        'mongo_indexes': address_indexes
     }
 
     private_addresses = {
@@ -65,7 +130,28 @@ class ResourceSchema(object):
             'url': lookup_url,
             'field': 'address'
         },
-        'schema': address_schema
+        'schema': address_schema,
+        'mongo_indexes': address_indexes
+    }
+
+    public_address_ranges = {
+        'item_title': 'public-address-range',
+        'additional_lookup': {
+            'url': lookup_url,
+            'field': 'block'
+        },
+        'schema': address_range_schema,
+        'mongo_indexes': address_range_indexes
+    }
+
+    private_address_ranges = {
+        'item_title': 'private-address-range',
+        'additional_lookup': {
+            'url': lookup_url,
+            'field': 'block'
+        },
+        'schema': address_range_schema,
+        'mongo_indexes': address_range_indexes
     }
 
 
@@ -73,5 +159,7 @@ schema = ResourceSchema()
 DOMAIN = {
     'machines': schema.machines,
     'public-addresses': schema.public_addresses,
-    'private-addresses': schema.private_addresses
+    'private-addresses': schema.private_addresses,
+    'public-address-ranges': schema.public_address_ranges,
+    'private-address-ranges': schema.private_address_ranges
 }
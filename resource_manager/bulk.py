@@ -0,0 +1,447 @@
+import uuid
+from datetime import datetime
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from eve.auth import resource_auth
+from eve.utils import config, document_etag
+from pymongo import ReturnDocument, UpdateOne
+
+from ranges import assign, covered, parse_address, pick, release, size, validate
+
+bulk = Blueprint('bulk', __name__)
+
+# how many times a range operation re-reads a block changed by someone else
+RANGE_WRITE_ATTEMPTS = 5
+
+
+def get_collection(resource):
+    source = current_app.config['DOMAIN'][resource]['datasource']['source']
+    return current_app.data.driver.db[source]
+
+
+def check_auth(resource):
+    if resource not in current_app.config['DOMAIN']:
+        abort(404)
+    auth = resource_auth(resource)
+    if auth and not auth.authorized([], resource, request.method):
+        auth.authenticate()
+
+
+def check_query(query):
+    """
+    Refuse the operators Eve refuses in 'where' queries ($where, $regex)
+    anywhere in a filter.
+    """
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key in config.MONGO_QUERY_BLACKLIST:
+                abort(400, description='Query contains operators banned in MONGO_QUERY_BLACKLIST')
+            check_query(value)
+    elif isinstance(query, list):
+        for value in query:
+            check_query(value)
+
+
+def parse_body(*fields):
+    body = request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        abort(400, description='Request body must be a JSON object')
+    for field in fields:
+        if not isinstance(body.get(field), dict):
+            abort(400, description='"{0}" must be a JSON object'.format(field))
+    check_query(body['where'])
+    return body
+
+
+def validate_changes(resource, changes):
+    """
+    Validate a field patch against the resource schema. Dotted keys
+    ('tags.memory') are allowed for dict fields, the rest goes through the
+    Eve validator like a regular PATCH.
+
+    :return: dict of validation issues, empty if the patch is valid
+    """
+    schema = current_app.config['DOMAIN'][resource]['schema']
+    issues = {}
+    plain = {}
+    for field, value in changes.items():
+        if field.startswith('_') or field.startswith('$'):
+            issues[field] = 'field is read-only'
+        elif '.' in field:
+            root = field.split('.')[0]
+            if schema.get(root, {}).get('type') != 'dict':
+                issues[field] = 'unknown field'
+        else:
+            plain[field] = value
+    validator = current_app.validator(schema, resource)
+    if plain and not validator.validate_update(plain, None):
+        issues.update(validator.errors)
+    return issues
+
+
+def apply_changes(document, changes):
+    """
+    Apply a $set style patch, including dotted keys, to a copy of document.
+    """
+    updated = dict(document)
+    for field, value in changes.items():
+        path = field.split('.')
+        target = updated
+        for name in path[:-1]:
+            target[name] = dict(target.get(name) or {})
+            target = target[name]
+        target[path[-1]] = value
+    return updated
+
+
+def item_result(document, key, status='OK', issues=None):
+    result = {config.ID_FIELD: str(document[config.ID_FIELD]), key: document.get(key), config.STATUS: status}
+    if config.ETAG in document:
+        result[config.ETAG] = document[config.ETAG]
+    if issues:
+        result[config.ISSUES] = issues
+    return result
+
+
+def bulk_response(items):
+    status = 'OK' if all(item[config.STATUS] == 'OK' for item in items) else 'ERR'
+    return jsonify({config.STATUS: status, config.ITEMS: items})
+
+
+@bulk.route('/<resource>/update', methods=['POST'])
+def update(resource):
+    """
+    Apply a field patch to every document matching a filter:
+
+        POST /bulk/machines/update
+        {"where": {"job_id": "job-1"}, "set": {"owner": "", "state": "idle", "job_id": ""}}
+
+    All the writes are sent to Mongo as one bulk operation. Each write is
+    conditional on the document's etag, so a document changed by someone else
+    in the meantime is reported as an error instead of being overwritten.
+    """
+    check_auth(resource)
+    body = parse_body('where', 'set')
+    changes = body['set']
+    issues = validate_changes(resource, changes)
+    if issues:
+        return jsonify({config.STATUS: 'ERR', config.ISSUES: issues}), 422
+
+    collection = get_collection(resource)
+    key = current_app.config['DOMAIN'][resource]['additional_lookup']['field']
+    range_resource = 'ranges' in current_app.config['DOMAIN'][resource]['schema']
+    now = datetime.utcnow().replace(microsecond=0)
+    originals = list(collection.find(body['where']))
+    if not originals:
+        return bulk_response([])
+
+    updated = []
+    writes = []
+    rejected = {}
+    written = set()
+    for original in originals:
+        document = apply_changes(original, changes)
+        updated.append(document)
+        if range_resource:
+            try:
+                validate(document.get('block'), document.get('ranges', []))
+            except ValueError as e:
+                rejected[original[config.ID_FIELD]] = str(e)
+                continue
+        document[config.LAST_UPDATED] = now
+        document.pop(config.ETAG, None)
+        document[config.ETAG] = document_etag(document)
+        changes_set = dict(changes)
+        changes_set[config.LAST_UPDATED] = now
+        changes_set[config.ETAG] = document[config.ETAG]
+        writes.append(UpdateOne({config.ID_FIELD: original[config.ID_FIELD],
+                                 config.ETAG: original.get(config.ETAG)},
+                                {'$set': changes_set}))
+        written.add(original[config.ID_FIELD])
+    result = collection.bulk_write(writes, ordered=False) if writes else None
+    if result and result.matched_count < len(writes):
+        # find out which conditional writes lost a race
+        new_etags = [document[config.ETAG] for document in updated if document[config.ID_FIELD] in written]
+        written = set(document[config.ID_FIELD] for document in
+                      collection.find({config.ID_FIELD: {'$in': list(written)}, config.ETAG: {'$in': new_etags}},
+                                      projection=[config.ID_FIELD]))
+    items = []
+    for original, document in zip(originals, updated):
+        if document[config.ID_FIELD] in rejected:
+            items.append(item_result(original, key, 'ERR', {'ranges': rejected[document[config.ID_FIELD]]}))
+        elif document[config.ID_FIELD] in written:
+            items.append(item_result(document, key))
+        else:
+            items.append(item_result(original, key, 'ERR', {config.ETAG: 'document changed during the update'}))
+    return bulk_response(items)
+
+
+@bulk.route('/<resource>/delete', methods=['POST'])
+def delete(resource):
+    """
+    Delete every document matching a filter:
+
+        POST /bulk/public-addresses/delete
+        {"where": {"owner": "job-1"}}
+    """
+    check_auth(resource)
+    body = parse_body('where')
+    collection = get_collection(resource)
+    key = current_app.config['DOMAIN'][resource]['additional_lookup']['field']
+    documents = list(collection.find(body['where'], projection=[key]))
+    if documents:
+        collection.delete_many({config.ID_FIELD: {'$in': [document[config.ID_FIELD] for document in documents]}})
+    return bulk_response([item_result(document, key) for document in documents])
+
+
+@bulk.route('/<resource>/claim', methods=['POST'])
+def claim(resource):
+    """
+    Atomically claim up to count documents matching a filter:
+
+        POST /bulk/machines/claim
+        {"where": {"state": "idle"}, "count": 3, "set": {"owner": "tony", "state": "pxe", "job_id": "job-1"}}
+
+    Every document is taken with its own findAndModify, so two concurrent
+    claims can never get the same document. Fewer than count documents are
+    returned when not enough of them match.
+    """
+    check_auth(resource)
+    body = parse_body('where', 'set')
+    count = body.get('count')
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        abort(400, description='"count" must be a positive integer')
+    changes = body['set']
+    issues = validate_changes(resource, changes)
+    if issues:
+        return jsonify({config.STATUS: 'ERR', config.ISSUES: issues}), 422
+
+    collection = get_collection(resource)
+    key = current_app.config['DOMAIN'][resource]['additional_lookup']['field']
+    now = datetime.utcnow().replace(microsecond=0)
+    claimed = []
+    while len(claimed) < count:
+        # skip what we already hold in case the patch doesn't take documents out of the filter
+        query = {'$and': [body['where'], {config.ID_FIELD: {'$nin': [item[config.ID_FIELD] for item in claimed]}}]}
+        changes_set = dict(changes)
+        changes_set[config.LAST_UPDATED] = now
+        # etags are opaque to Eve once stored, a fresh unique value is enough to invalidate the old one
+        changes_set[config.ETAG] = uuid.uuid4().hex
+        document = collection.find_one_and_update(query, {'$set': changes_set},
+                                                  projection=[key, config.ETAG],
+                                                  return_document=ReturnDocument.AFTER)
+        if document is None:
+            break
+        claimed.append(document)
+    return bulk_response([item_result(document, key) for document in claimed])
+
+
+def check_ranges(resource):
+    if 'ranges' not in current_app.config['DOMAIN'][resource]['schema']:
+        abort(400, description='{0} is not an address range resource'.format(resource))
+
+
+def check_block(resource, document, original=None):
+    """
+    Refuse an address block with invalid sub-ranges, see ranges.validate.
+
+    :param document: the block, or the fields changed on original
+    """
+    if 'ranges' not in current_app.config['DOMAIN'][resource]['schema']:
+        return
+    block = dict(original or {})
+    block.update(document)
+    try:
+        validate(block.get('block'), block.get('ranges', []))
+    except ValueError as e:
+        abort(422, description=str(e))
+
+
+def check_inserted_blocks(resource, items):
+    """
+    on_insert hook, see server.py.
+    """
+    for item in items:
+        check_block(resource, item)
+
+
+def check_replaced_block(resource, item, original):
+    """
+    on_replace hook, see server.py.
+    """
+    check_block(resource, item)
+
+
+def check_updated_block(resource, updates, original):
+    """
+    on_update hook, see server.py.
+    """
+    check_block(resource, updates, original)
+
+
+def valid_blocks(blocks):
+    """
+    Leave out the blocks with invalid sub-ranges, stored before they were
+    validated, instead of failing the whole request on them.
+    """
+    for block in blocks:
+        try:
+            validate(block.get('block'), block.get('ranges', []))
+        except ValueError:
+            continue
+        yield block
+
+
+def check_owner(body, allow_empty=False):
+    owner = body.get('owner')
+    if not isinstance(owner, basestring) or (not owner and not allow_empty):
+        abort(400, description='"owner" must be a non empty string')
+    return owner
+
+
+def write_ranges(collection, block, ranges, now):
+    """
+    Replace the sub-ranges of a block, unless someone changed it since it was
+    read.
+
+    :return: the new etag of the block, None if it was changed in the meantime
+    """
+    etag = uuid.uuid4().hex
+    result = collection.update_one({config.ID_FIELD: block[config.ID_FIELD], config.ETAG: block.get(config.ETAG)},
+                                   {'$set': {'ranges': ranges, config.LAST_UPDATED: now, config.ETAG: etag}})
+    return etag if result.matched_count else None
+
+
+def range_result(block, etag, first, last, owner, status='OK', issues=None):
+    result = {config.ID_FIELD: str(block[config.ID_FIELD]), 'block': block['block'], config.ETAG: etag,
+              'first': first, 'last': last, 'owner': owner, config.STATUS: status}
+    if issues:
+        result[config.ISSUES] = issues
+    return result
+
+
+@bulk.route('/<resource>/reserve', methods=['POST'])
+def reserve(resource):
+    """
+    Reserve count addresses from the address blocks matching a filter:
+
+        POST /bulk/public-address-ranges/reserve
+        {"where": {"tags.subnet": "a"}, "count": 16, "owner": "job-1"}
+
+    The addresses are taken from the smallest free sub-range that holds them
+    all, or from as few free sub-ranges as possible, which are split and the
+    reserved parts given to owner. One item is returned per reserved
+    sub-range. Each block is written conditionally on its etag, the part of
+    the reservation lost to a concurrent write is picked again.
+
+    A reservation is all or nothing: when count addresses can't be reserved,
+    because not enough of them are free or too many writes were lost, what
+    was already reserved is released and an error is returned with no items.
+    """
+    check_auth(resource)
+    check_ranges(resource)
+    body = parse_body('where')
+    count = body.get('count')
+    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+        abort(400, description='"count" must be a positive integer')
+    owner = check_owner(body)
+
+    collection = get_collection(resource)
+    now = datetime.utcnow().replace(microsecond=0)
+    items = []
+    reserved = []
+    remaining = count
+    for _ in range(RANGE_WRITE_ATTEMPTS):
+        blocks = list(valid_blocks(collection.find({'$and': [body['where'], {'ranges.owner': ''}]})))
+        picked = pick(blocks, remaining)
+        if not picked:
+            break
+        for index in sorted(set(index for index, _, _ in picked)):
+            pieces = [(first, last) for picked_index, first, last in picked if picked_index == index]
+            ranges = blocks[index]['ranges']
+            for first, last in pieces:
+                ranges = assign(ranges, first, last, owner)
+            etag = write_ranges(collection, blocks[index], ranges, now)
+            if etag:
+                for first, last in pieces:
+                    items.append(range_result(blocks[index], etag, first, last, owner))
+                    reserved.append((blocks[index][config.ID_FIELD], first, last))
+                    remaining -= size({'first': first, 'last': last})
+        if not remaining:
+            break
+    if remaining:
+        give_back(collection, reserved, owner, now)
+        return jsonify({config.STATUS: 'ERR', config.ITEMS: [],
+                        config.ISSUES: {'count': 'only {0} of the {1} addresses could be reserved'.format(
+                            count - remaining, count)}})
+    return bulk_response(items)
+
+
+def give_back(collection, reserved, owner, now):
+    """
+    Release the sub-ranges of a reservation that could not be completed.
+
+    :param reserved: list of (block _id, first, last)
+    """
+    for block_id, first, last in reserved:
+        for _ in range(RANGE_WRITE_ATTEMPTS):
+            block = collection.find_one({config.ID_FIELD: block_id})
+            if block is None:
+                break
+            try:
+                ranges, _ = release(block['ranges'], owner, first, last)
+            except ValueError:
+                # already released by someone else
+                break
+            if write_ranges(collection, block, ranges, now):
+                break
+
+
+@bulk.route('/<resource>/release', methods=['POST'])
+def release_ranges(resource):
+    """
+    Free the addresses an owner holds in the address blocks matching a
+    filter, all of them or only those between first and last:
+
+        POST /bulk/public-address-ranges/release
+        {"where": {}, "owner": "job-1"}
+
+        POST /bulk/public-address-ranges/release
+        {"where": {"block": "10.111.0.0-10.111.15.255"}, "owner": "job-1", "first": "10.111.1.5"}
+
+    The freed addresses are merged back with the free sub-ranges around them.
+    One item is returned per freed sub-range.
+    """
+    check_auth(resource)
+    check_ranges(resource)
+    body = parse_body('where')
+    owner = check_owner(body)
+    first, last = body.get('first'), body.get('last')
+    for address in (first, last):
+        if address is not None:
+            try:
+                parse_address(address)
+            except ValueError as e:
+                abort(400, description=str(e))
+
+    collection = get_collection(resource)
+    now = datetime.utcnow().replace(microsecond=0)
+    items = []
+    for block in valid_blocks(collection.find({'$and': [body['where'], {'ranges.owner': owner}]})):
+        if first is not None and not covered(block['ranges'], first, last or first):
+            continue
+        for _ in range(RANGE_WRITE_ATTEMPTS):
+            try:
+                ranges, freed = release(block['ranges'], owner, first, last)
+            except ValueError as e:
+                items.append(range_result(block, block.get(config.ETAG), first, last or first, owner, 'ERR',
+                                          {'owner': str(e)}))
+                break
+            etag = write_ranges(collection, block, ranges, now)
+            if etag:
+                items.extend(range_result(block, etag, item['first'], item['last'], '') for item in freed)
+                break
+            block = collection.find_one({config.ID_FIELD: block[config.ID_FIELD]})
+            if block is None:
+                break
+    return bulk_response(items)
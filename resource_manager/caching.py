@@ -0,0 +1,14 @@
+from flask import request
+
+
+def add_collection_etag(response):
+    """
+    Eve doesn't send a validator with collection responses. Tag successful
+    GETs that lack one with an ETag of the body, and answer a matching
+    If-None-Match with a bodyless 304, so clients can revalidate a cached
+    listing without downloading it again.
+    """
+    if request.method == 'GET' and response.status_code == 200 and 'ETag' not in response.headers:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
@@ -1,9 +1,18 @@
 #!/usr/bin/python
+import calendar
 import json
+import threading
+import time
 import urllib
+from email.utils import parsedate
 import requests
 import argparse
+from multiprocessing.pool import ThreadPool
 from prettytable import PrettyTable
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from ranges import expand
 
 
 class RequestFailureException(Exception):
@@ -16,27 +25,281 @@ class RequestFailureException(Exception):
         return "{0}:{1}".format(status_code, text)
 
 
+class ConcurrentRequestFailureException(Exception):
+    def __init__(self, results, failures):
+        self.results = results
+        self.failures = failures
+
+    def __str__(self):
+        return "{0} of {1} requests failed: {2}".format(len(self.failures), len(self.results),
+                                                        "; ".join(str(failure) for _, failure in self.failures))
+
+
 class ResourceManagerClient(object):
     FIELDS = {'machines': ["hostname", "owner", "state", "job_id", "tags", "_updated", "_id"],
               'private-addresses': ["address", "owner", "tags", "_updated", "_id"],
-              'public-addresses': ["address",  "owner", "tags", "_updated", "_id"]}
+              'public-addresses': ["address",  "owner", "tags", "_updated", "_id"],
+              'private-address-ranges': ["block", "ranges", "tags", "_updated", "_id"],
+              'public-address-ranges': ["block", "ranges", "tags", "_updated", "_id"]}
+
+    RETRY_STATUSES = [502, 503, 504]
 
-    def __init__(self, resource_type='machines', endpoint='http://127.0.0.1:5000', username='admin', password='admin'):
+    def __init__(self, resource_type='machines', endpoint='http://127.0.0.1:5000', username='admin', password='admin',
+                 timeout=(3.05, 30), retries=3, backoff_factor=0.5, pool_size=10, page_size=200, cache_ttl=None):
+        '''
+        :param resource_type: collection to operate on (see FIELDS)
+        :param endpoint: base URL of the resource manager API
+        :param username: user for write operations
+        :param password: password for write operations
+        :param timeout: (connect, read) timeout in seconds applied to every request
+        :param retries: how many times an idempotent request is retried on connection errors or 502/503/504
+        :param backoff_factor: exponential backoff factor between retries (0.5 -> 0s, 1s, 2s, ...)
+        :param pool_size: number of keep-alive connections kept open to the endpoint
+        :param page_size: number of resources fetched per request when listing
+        :param cache_ttl: seconds a listing is served from the local cache before it is revalidated with the server,
+                          None disables the cache. Writes made through this client always invalidate it.
+        '''
         self.endpoint = endpoint + '/' + resource_type
+        self.bulk_endpoint = endpoint + '/bulk/' + resource_type
         self.resource_type = resource_type
         self.key = self.FIELDS[self.resource_type][0]
         self.auth = (username, password)
         self.headers = {'content-type': 'application/json'}
         self.fields = self.FIELDS[self.resource_type]
+        self.timeout = timeout
+        self.page_size = page_size
+        self.cache_ttl = cache_ttl
+        # listing parameters -> (expiry time, ETag, page)
+        self._cache = {}
+        # resource name -> (_id, _etag) as last seen from the server
+        self._etags = {}
+        # guards _cache and _etags, the client may be shared by threads (see ConcurrentResourceManagerClient)
+        self._lock = threading.Lock()
+        self.session = self._create_session(retries, backoff_factor, pool_size)
+
+    def _create_session(self, retries, backoff_factor, pool_size):
+        '''
+        Build the keep-alive session every request goes through. Retries are
+        only replayed for the idempotent verbs urllib3 whitelists by default
+        (GET, HEAD, PUT, DELETE, OPTIONS, TRACE), never for POST or PATCH.
+        '''
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=self.RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, auth=self.auth, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def invalidate_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _set_etag(self, resource_name, identifier, etag):
+        with self._lock:
+            self._etags[resource_name] = (identifier, etag)
+
+    def _forget_etag(self, resource_name):
+        with self._lock:
+            self._etags.pop(resource_name, None)
+
+    def _cached_etag(self, resource_name):
+        '''
+        :return: (_id, _etag) last seen for a resource, None if unknown
+        '''
+        with self._lock:
+            return self._etags.get(resource_name)
 
     def create_resource(self, resource):
-        resource = requests.post(self.endpoint, data=resource, headers=self.headers, auth=self.auth)
+        self.invalidate_cache()
+        resource = self._request('POST', self.endpoint, data=resource, headers=self.headers)
         if resource.status_code != 201:
             raise RequestFailureException(resource)
 
+    def create_resources(self, resources):
+        '''
+        Create many resources with a single request using Eve's bulk insert.
+
+        :param resources: list of resource dicts
+        :return: list of the created items as returned by the server
+        '''
+        self.invalidate_cache()
+        response = self._request('POST', self.endpoint, data=json.dumps(resources), headers=self.headers)
+        if response.status_code != 201:
+            raise RequestFailureException(response)
+        items = response.json().get('_items', [response.json()])
+        for resource, item in zip(resources, items):
+            if '_etag' in item:
+                self._set_etag(resource[self.key], item['_id'], item['_etag'])
+        return items
+
+    def update_resources(self, where, changes):
+        '''
+        Set fields on every resource matching a filter with a single request.
+        The server applies the change in one database operation and reports a
+        result per resource, each with a '_status' of 'OK' or 'ERR'.
+
+            client.update_resources({'job_id': 'job-1'}, {'owner': '', 'state': 'idle', 'job_id': ''})
+
+        :param where: (dict) filter selecting the resources to change
+        :param changes: (dict) fields to set, dotted keys like 'tags.memory' are allowed
+        :return: list of per resource results
+        '''
+        return self._bulk_request('update', {'where': where, 'set': changes})
+
+    def delete_resources(self, where):
+        '''
+        Delete every resource matching a filter with a single request.
+
+        :param where: (dict) filter selecting the resources to delete
+        :return: list of per resource results
+        '''
+        return self._bulk_request('delete', {'where': where})
+
+    def claim_resources(self, where, count, changes):
+        '''
+        Atomically claim up to count resources matching a filter and set fields
+        on them. A resource can only ever be claimed by one caller, so this is
+        safe against concurrent reservations.
+
+            client.claim_resources({'state': 'idle'}, 3, {'owner': 'tony', 'state': 'pxe', 'job_id': 'job-1'})
+
+        :param where: (dict) filter selecting the resources that may be claimed
+        :param count: maximum number of resources to claim
+        :param changes: (dict) fields to set on the claimed resources
+        :return: list of the claimed resources, shorter than count if not enough matched
+        '''
+        return self._bulk_request('claim', {'where': where, 'count': count, 'set': changes})
+
+    def _bulk_request(self, operation, body):
+        self.invalidate_cache()
+        response = self._request('POST', self.bulk_endpoint + '/' + operation, data=json.dumps(body),
+                                 headers=self.headers)
+        if response.status_code != 200:
+            raise RequestFailureException(response)
+        items = response.json()['_items']
+        for item in items:
+            if item['_status'] == 'OK' and operation != 'delete':
+                self._remember(item)
+            else:
+                self._forget_etag(item[self.key])
+        return items
+
+    def reserve_addresses(self, count, owner, where=None, expand_ranges=True):
+        '''
+        Reserve count addresses from an address range resource. The server
+        splits the free sub-ranges of the blocks matching where, see
+        bulk.reserve.
+
+            client = ResourceManagerClient('public-address-ranges')
+            client.reserve_addresses(16, 'job-1', where={'tags.subnet': 'a'})
+
+        :param count: how many addresses to reserve
+        :param owner: who the addresses are for
+        :param where: (dict) filter on the address blocks
+        :param expand_ranges: return addresses instead of sub-ranges
+        :return: list of the reserved addresses, or of the reserved sub-ranges
+                 ({'block', 'first', 'last', 'owner', ...}), empty if count
+                 addresses could not be reserved
+        '''
+        items = self._bulk_request('reserve', {'where': where or {}, 'count': count, 'owner': owner})
+        if not expand_ranges:
+            return items
+        return [address['address'] for item in items if item['_status'] == 'OK'
+                for address in expand({'ranges': [item]})]
+
+    def release_addresses(self, owner, where=None, first=None, last=None):
+        '''
+        Free the addresses an owner holds in an address range resource, all of
+        them or only the ones between first and last.
+
+        :param owner: whose addresses to free
+        :param where: (dict) filter on the address blocks
+        :param first: first address to free
+        :param last: last address to free, defaults to first
+        :return: list of the freed sub-ranges
+        '''
+        body = {'where': where or {}, 'owner': owner}
+        if first is not None:
+            body['first'] = first
+            body['last'] = last or first
+        return self._bulk_request('release', body)
+
+    def iter_addresses(self, where=None, owner=None):
+        '''
+        Generator expanding the blocks of an address range resource into
+        address documents like the ones of public-addresses/private-addresses.
+
+        :param where: (dict) filter on the address blocks
+        :param owner: only the addresses of this owner ('' for the free ones),
+                      all of them if None
+        :return: generator of {'address', 'owner', 'block', 'tags'} dicts
+        '''
+        if owner is not None:
+            where = {'$and': [where or {}, {'ranges.owner': owner}]}
+        for block in self.iter_resources(where=where):
+            for address in expand(block, owner=owner):
+                yield address
+
     def get_resource(self, name):
         url = self.endpoint + '/' + urllib.quote_plus(name)
-        return requests.get(url, auth=self.auth).json()
+        return self._remember(self._request('GET', url).json())
+
+    def _remember(self, resource):
+        '''
+        Record the _id and _etag of a document returned by the server so a
+        later write to it doesn't need to GET it first.
+        '''
+        if self.key in resource and '_etag' in resource:
+            self._set_etag(resource[self.key], resource['_id'], resource['_etag'])
+        return resource
+
+    def _write_resource(self, method, resource):
+        '''
+        Send a write to the item endpoint using the cached _id and _etag. If
+        the cached values are stale (412, or 404 because the document was
+        recreated) they are refreshed from the server and the write retried.
+
+        :return: the server response
+        '''
+        self.invalidate_cache()
+        resource_name = json.loads(resource)[self.key]
+        cached = self._cached_etag(resource_name) is not None
+        response = self._send_write(method, resource_name, resource)
+        if cached and response.status_code in (404, 412):
+            self._forget_etag(resource_name)
+            response = self._send_write(method, resource_name, resource)
+        self._forget_etag(resource_name)
+        if response.status_code == 200 and method != 'DELETE':
+            written = response.json()
+            if '_etag' in written:
+                self._set_etag(resource_name, written['_id'], written['_etag'])
+        return response
+
+    def _send_write(self, method, resource_name, resource):
+        cached = self._cached_etag(resource_name)
+        if cached is None:
+            server_response = self.get_resource(resource_name)
+            cached = (server_response['_id'], server_response['_etag'])
+            self._set_etag(resource_name, *cached)
+        identifier, etag = cached
+        request_url = self.endpoint + "/" + identifier
+        headers = dict(self.headers)
+        headers['If-Match'] = etag
+        return self._request(method, request_url, data=resource, headers=headers)
 
     def update_resource(self, resource):
         '''
@@ -50,14 +313,7 @@ class ResourceManagerClient(object):
         :param resource:
         :return:
         '''
-        resource_name = json.loads(resource)[self.key]
-        server_response = self.get_resource(resource_name)
-        identifier = server_response['_id']
-        etag = server_response['_etag']
-        request_url = self.endpoint + "/" + identifier
-        headers = self.headers
-        headers['If-Match'] = etag
-        updated_resource = requests.patch(request_url, data=resource, headers=self.headers, auth=self.auth)
+        updated_resource = self._write_resource('PATCH', resource)
         if updated_resource.status_code != 200:
             raise RequestFailureException(updated_resource)
 
@@ -71,38 +327,236 @@ class ResourceManagerClient(object):
         :param resource:
         :return:
         '''
-        resource_name = json.loads(resource)[self.key]
-        server_response = self.get_resource(resource_name)
-        identifier = server_response['_id']
-        etag = server_response['_etag']
-        request_url = self.endpoint + "/" + identifier
-        headers = self.headers
-        headers['If-Match'] = etag
-        updated_resource = requests.put(request_url, data=resource, headers=self.headers, auth=self.auth)
+        updated_resource = self._write_resource('PUT', resource)
         if updated_resource.status_code != 200:
             raise RequestFailureException(updated_resource)
 
     def delete_resource(self, resource):
-        resource_name = json.loads(resource)[self.key]
-        server_response = self.get_resource(resource_name)
-        identifier = server_response['_id']
-        etag = server_response['_etag']
-        request_url = self.endpoint + "/" + identifier
-        headers = self.headers
-        headers['If-Match'] = etag
-        deleted_resource = requests.delete(request_url, data=resource, headers=self.headers, auth=self.auth)
-        if deleted_resource.status_code != 200:
+        deleted_resource = self._write_resource('DELETE', resource)
+        if deleted_resource.status_code not in (200, 204):
             raise RequestFailureException(deleted_resource)
 
-    def find_resources(self, field, value):
-        filtered_results = [resource for resource in self.get_all_resources() if resource[field] == value]
-        return filtered_results
+    def find_resources(self, field, value, fields=None):
+        '''
+        Find the resources whose field matches value. The filter is evaluated
+        by the server so only the matching documents are transferred. If value
+        is a list or tuple, resources matching any of its members are returned.
+
+        :param field: name of the field to filter on
+        :param value: value (or list of values) the field must match
+        :param fields: list of fields to fetch, all of them if None
+        :return: list of matching resources
+        '''
+        if isinstance(value, (list, tuple)):
+            value = {'$in': list(value)}
+        return self.query_resources({field: value}, fields=fields)
+
+    def query_resources(self, where, fields=None):
+        '''
+        Run an Eve 'where' query against the collection. The query is a
+        MongoDB style filter, so compound and operator filters work as well:
+
+            client.query_resources({'state': 'idle', 'owner': ''})
+            client.query_resources({'hostname': {'$in': ['a-01', 'a-02']}})
+            client.query_resources({'tags.memory': {'$gte': 17179869184}})
+
+        :param where: (dict) filter to apply on the server
+        :param fields: list of fields to fetch, all of them if None
+        :return: list of matching resources
+        '''
+        return list(self.iter_resources(where=where, fields=fields))
+
+    def iter_resources(self, where=None, fields=None, page_size=None):
+        '''
+        Generator walking the collection one page at a time, so memory use
+        and time to the first result don't grow with the collection. Pages
+        are sorted on _id and each one starts after the last _id seen, so
+        resources added or removed while walking don't make it skip or
+        repeat the others.
+
+            for machine in client.iter_resources(where={'state': 'idle'}, fields=['hostname']):
+                print machine['hostname']
+
+        :param where: (dict) filter to apply on the server, everything if None
+        :param fields: list of fields to fetch, all of them if None. The
+                       resource key, _id and _etag are always included.
+        :param page_size: resources per request, defaults to the client's page_size
+        '''
+        page_size = page_size or self.page_size
+        params = {'max_results': page_size, 'page': 1, 'sort': '[("_id", 1)]'}
+        if where is not None:
+            params['where'] = json.dumps(where)
+        if fields:
+            params['projection'] = json.dumps(dict((field, 1) for field in [self.key] + list(fields)))
+        while True:
+            page = self._get_page(params)
+            for item in page["_items"]:
+                yield self._remember(item)
+            # the server caps max_results at its PAGINATION_LIMIT, a page is short compared to what it really used
+            if not page["_items"] or len(page["_items"]) < page.get("_meta", {}).get("max_results", page_size):
+                return
+            after = {'_id': {'$gt': page["_items"][-1]['_id']}}
+            params['where'] = json.dumps({'$and': [where, after]} if where is not None else after)
 
     def get_all_resources(self):
-        return requests.get(self.endpoint, auth=self.auth).json()["_items"]
+        return list(self.iter_resources())
+
+    def count_resources(self, where=None):
+        '''
+        :param where: (dict) filter to apply on the server, everything if None
+        :return: number of matching resources, without downloading them
+        '''
+        params = {'max_results': 1, 'page': 1, 'projection': json.dumps({self.key: 1})}
+        if where is not None:
+            params['where'] = json.dumps(where)
+        return self._get_page(params)['_meta']['total']
+
+    def _get_page(self, params):
+        '''
+        Fetch one page of a listing, going through the cache when it is enabled.
+        A fresh cached page is returned without contacting the server, a stale
+        one is revalidated with If-None-Match and reused if the server answers
+        304 Not Modified. The cache keeps the response text and every hit is
+        parsed again, so callers can modify what they get.
+        '''
+        if self.cache_ttl is None:
+            response = self._request('GET', self.endpoint, params=params)
+            if response.status_code != 200:
+                raise RequestFailureException(response)
+            return response.json()
+
+        key = tuple(sorted(params.items()))
+        with self._lock:
+            expires, etag, text = self._cache.get(key, (0, None, None))
+        if time.time() < expires:
+            return json.loads(text)
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self._request('GET', self.endpoint, params=params, headers=headers)
+        if response.status_code == 304 and text is not None:
+            with self._lock:
+                self._cache[key] = (time.time() + self.cache_ttl, etag, text)
+            return json.loads(text)
+        if response.status_code != 200:
+            raise RequestFailureException(response)
+        with self._lock:
+            self._cache[key] = (time.time() + self.cache_ttl, response.headers.get('ETag'), response.text)
+        return json.loads(response.text)
+
+
+class ResourceMirror(object):
+    '''
+    Local copy of a collection kept current by incremental syncs. After the
+    first full download, sync() only fetches the resources whose _updated is
+    at or after the newest one already seen. Deletions are detected by
+    comparing the collection size with the mirror, and only when they differ
+    are the keys of the collection listed to prune the deleted resources.
+
+        mirror = ResourceMirror(ResourceManagerClient('machines'))
+        updated, deleted = mirror.sync()
+        mirror.resources['a-01.qa1.eucalyptus-systems.com']['state']
+    '''
+    def __init__(self, client, fields=None):
+        '''
+        :param client: ResourceManagerClient for the collection to mirror
+        :param fields: list of fields to keep, all of them if None
+        '''
+        self.client = client
+        self.fields = fields + ['_updated'] if fields else None
+        self.resources = {}
+        self.watermark = None
+
+    def sync(self):
+        '''
+        Bring the mirror up to date with the server.
+
+        :return: (updated, deleted) lists of the keys that changed since the last sync
+        '''
+        key = self.client.key
+        # _updated has a one second resolution so resources changed in the
+        # same second as the watermark are fetched again rather than missed
+        where = {'_updated': {'$gte': self.watermark}} if self.watermark else None
+        newest = self._timestamp(self.watermark)
+        updated = []
+        for resource in self.client.iter_resources(where=where, fields=self.fields):
+            if self.resources.get(resource[key]) != resource:
+                updated.append(resource[key])
+            self.resources[resource[key]] = resource
+            if self._timestamp(resource.get('_updated')) > newest:
+                newest = self._timestamp(resource['_updated'])
+                self.watermark = resource['_updated']
+
+        deleted = []
+        if self.client.count_resources() != len(self.resources):
+            current = set(resource[key] for resource in self.client.iter_resources(fields=[key]))
+            deleted = [name for name in self.resources if name not in current]
+            for name in deleted:
+                del self.resources[name]
+        return updated, deleted
+
+    @staticmethod
+    def _timestamp(updated):
+        if not updated:
+            return 0
+        return calendar.timegm(parsedate(updated))
+
+
+class ConcurrentResourceManagerClient(ResourceManagerClient):
+    '''
+    ResourceManagerClient that can fan out many independent requests at once.
+    asyncio isn't available on the Python 2 versions we support, so requests
+    run on a bounded pool of threads that share the client's keep-alive
+    connection pool.
+
+        client = ConcurrentResourceManagerClient(concurrency=20)
+        client.map('put_resource', [json.dumps(machine) for machine in machines])
+    '''
+    def __init__(self, resource_type='machines', endpoint='http://127.0.0.1:5000', username='admin', password='admin',
+                 concurrency=10, **kwargs):
+        '''
+        :param concurrency: maximum number of requests in flight at once
+        The remaining parameters are the same as for ResourceManagerClient.
+        '''
+        kwargs.setdefault('pool_size', concurrency)
+        super(ConcurrentResourceManagerClient, self).__init__(resource_type, endpoint, username, password, **kwargs)
+        self.concurrency = concurrency
+        self._pool = None
+
+    def map(self, operation, arguments):
+        '''
+        Call a client method once per argument, at most concurrency at a time.
+
+        :param operation: name of the method to call, ex: 'update_resource'
+        :param arguments: list of arguments, one per call
+        :return: list of the results, in the order of arguments
+        :raises ConcurrentRequestFailureException: after all the calls are done, if any of them failed
+        '''
+        method = getattr(self, operation)
+
+        def call(argument):
+            try:
+                return True, method(argument)
+            except Exception as e:
+                return False, e
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        outcomes = self._pool.map(call, arguments)
+        results = [result for _, result in outcomes]
+        failures = [(argument, result) for argument, (succeeded, result) in zip(arguments, outcomes)
+                    if not succeeded]
+        if failures:
+            raise ConcurrentRequestFailureException(results, failures)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        super(ConcurrentResourceManagerClient, self).close()
 
 if __name__ == "__main__":
-    resources = ['machines', 'public-addresses', 'private-addresses']
+    resources = ['machines', 'public-addresses', 'private-addresses', 'public-address-ranges', 'private-address-ranges']
     operations = ['create', 'list', 'update', 'delete']
     parser = argparse.ArgumentParser(description='Access resource manager api.')
     parser.add_argument('operation', choices=operations)
@@ -110,12 +564,14 @@ if __name__ == "__main__":
                         choices=resources)
     parser.add_argument('--endpoint', '-e', help='API endpoint to connect to', default='http://127.0.0.1:5000')
     parser.add_argument('--json', '-j', help='JSON defining object to add/remove')
+    parser.add_argument('--where', '-w', help='JSON filter to apply to list, ex: \'{"state": "idle"}\'')
     args = parser.parse_args()
     client = ResourceManagerClient(args.resource_type, args.endpoint)
     if args.operation == 'create':
         client.create_resource(args.json)
     elif args.operation == 'list':
-        items = client.get_all_resources()
+        where = json.loads(args.where) if args.where else None
+        items = client.iter_resources(where=where, fields=client.fields)
         table = PrettyTable(client.fields)
         for resource in items:
             table.add_row([resource.get(field, None) for field in client.fields])
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Report which index MongoDB picks for the queries the resource manager
+# clients run most often, and how many documents it has to look at to answer
+# them. A COLLSCAN, or a docs examined count far above the number returned,
+# means an index from api_config.py is missing or not being used.
+#
+import argparse
+from datetime import datetime
+
+from prettytable import PrettyTable
+from pymongo import MongoClient
+
+QUERIES = {'machines': [{'state': 'idle'},
+                        {'state': 'idle', 'tags.memory': {'$gte': 17179869184}},
+                        {'state': 'ready', 'distro': 'centos'},
+                        {'owner': 'tony', 'job_id': 'job-1'},
+                        {'job_id': 'job-1'},
+                        {'hostname': 'a-01.qa1.eucalyptus-systems.com'},
+                        {'_updated': {'$gte': datetime(2017, 1, 1)}}],
+           'public-addresses': [{'owner': ''},
+                                {'owner': 'job-1'},
+                                {'address': '10.111.1.1'},
+                                {'_updated': {'$gte': datetime(2017, 1, 1)}}],
+           'private-addresses': [{'owner': ''},
+                                 {'owner': 'job-1'},
+                                 {'address': '10.111.1.1'},
+                                 {'_updated': {'$gte': datetime(2017, 1, 1)}}],
+           # bulk reserve and release, see bulk.py
+           'public-address-ranges': [{'$and': [{}, {'ranges.owner': ''}]},
+                                     {'$and': [{'tags.subnet': 'a'}, {'ranges.owner': ''}]},
+                                     {'$and': [{}, {'ranges.owner': 'job-1'}]},
+                                     {'block': '10.111.0.0-10.111.15.255'},
+                                     {'_updated': {'$gte': datetime(2017, 1, 1)}}],
+           'private-address-ranges': [{'$and': [{}, {'ranges.owner': ''}]},
+                                      {'$and': [{'tags.subnet': 'a'}, {'ranges.owner': ''}]},
+                                      {'$and': [{}, {'ranges.owner': 'job-1'}]},
+                                      {'block': '10.111.0.0-10.111.15.255'},
+                                      {'_updated': {'$gte': datetime(2017, 1, 1)}}]}
+
+
+def find_stages(plan):
+    """
+    Flatten a winning plan into the list of its stages, innermost first.
+    """
+    stages = []
+    for child in plan.get('inputStages', []) + [plan.get('inputStage', {})]:
+        if child:
+            stages.extend(find_stages(child))
+    stages.append(plan)
+    return stages
+
+
+def explain(collection, query):
+    plan = collection.find(query).explain()
+    stages = find_stages(plan['queryPlanner']['winningPlan'])
+    scans = [stage for stage in stages if stage['stage'] in ('IXSCAN', 'COLLSCAN')]
+    stats = plan.get('executionStats', {})
+    return {'scan': ', '.join(stage['stage'] for stage in scans),
+            'index': ', '.join(stage.get('indexName', '-') for stage in scans),
+            'examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report index usage for common resource manager queries.')
+    parser.add_argument('--host', default='127.0.0.1', help='MongoDB host')
+    parser.add_argument('--port', default=27017, type=int, help='MongoDB port')
+    parser.add_argument('--db', default='eve', help='Database the resource manager uses')
+    args = parser.parse_args()
+    db = MongoClient(args.host, args.port)[args.db]
+    fields = ['collection', 'query', 'scan', 'index', 'examined', 'returned']
+    table = PrettyTable(fields)
+    for collection, queries in sorted(QUERIES.items()):
+        for query in queries:
+            result = explain(db[collection], query)
+            table.add_row([collection, query, result['scan'], result['index'], result['examined'],
+                           result['returned']])
+    print(table.get_string(fields=fields))
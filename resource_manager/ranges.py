@@ -0,0 +1,186 @@
+import socket
+import struct
+
+
+def ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def int_to_ip(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def parse_address(address):
+    """
+    Strict version of ip_to_int, only taking dotted quad IPv4 addresses.
+
+    :raise ValueError: if address is not an IPv4 address
+    """
+    if isinstance(address, basestring) and len(address.split('.')) == 4:
+        try:
+            return ip_to_int(address)
+        except (socket.error, UnicodeError):
+            pass
+    raise ValueError('"{0}" is not an IPv4 address'.format(address))
+
+
+def validate(block, ranges):
+    """
+    Check the sub-ranges of an address block: every first and last must be
+    an IPv4 address inside the block ("first-last" or a single address),
+    first not after last, and the sub-ranges must not overlap.
+
+    :raise ValueError: describing the first problem found
+    """
+    if not isinstance(block, basestring):
+        raise ValueError('"{0}" is not an address block'.format(block))
+    bounds = [parse_address(address) for address in block.split('-', 1)]
+    start, end = bounds[0], bounds[-1]
+    if start > end:
+        raise ValueError('{0} ends before it starts'.format(block))
+    previous = None
+    runs = [(parse_address(item['first']), parse_address(item['last']), item) for item in ranges]
+    for item_start, item_end, item in sorted(runs, key=lambda run: run[:2]):
+        if item_start > item_end:
+            raise ValueError('{0}-{1} ends before it starts'.format(item['first'], item['last']))
+        if item_start < start or item_end > end:
+            raise ValueError('{0}-{1} is not in {2}'.format(item['first'], item['last'], block))
+        if previous is not None and item_start <= previous[1]:
+            raise ValueError('{0}-{1} overlaps {2}-{3}'.format(item['first'], item['last'],
+                                                               previous[2]['first'], previous[2]['last']))
+        previous = (item_start, item_end, item)
+
+
+def normalize(ranges):
+    """
+    Sort the sub-ranges of an address block and merge the adjacent ones that
+    have the same owner.
+
+    :param ranges: list of {'first', 'last', 'owner'} dicts
+    :return: new list of sub-ranges
+    """
+    merged = []
+    for item in sorted(ranges, key=lambda item: ip_to_int(item['first'])):
+        owner = item.get('owner', '')
+        if merged and merged[-1]['owner'] == owner and ip_to_int(merged[-1]['last']) + 1 == ip_to_int(item['first']):
+            merged[-1]['last'] = item['last']
+        else:
+            merged.append({'first': item['first'], 'last': item['last'], 'owner': owner})
+    return merged
+
+
+def size(item):
+    return ip_to_int(item['last']) - ip_to_int(item['first']) + 1
+
+
+def covered(ranges, first, last):
+    """
+    :return: how many of the addresses first..last are in the sub-ranges
+    """
+    start, end = ip_to_int(first), ip_to_int(last)
+    return sum(max(0, min(end, ip_to_int(item['last'])) - max(start, ip_to_int(item['first'])) + 1)
+               for item in ranges)
+
+
+def assign(ranges, first, last, owner, current=''):
+    """
+    Give the addresses first..last to owner, splitting the sub-ranges they
+    fall in. Every address in first..last must belong to current.
+
+    :return: new list of sub-ranges
+    """
+    start, end = ip_to_int(first), ip_to_int(last)
+    if covered(ranges, first, last) != end - start + 1:
+        raise ValueError('{0}-{1} is not in the block'.format(first, last))
+    updated = []
+    for item in ranges:
+        item_start, item_end = ip_to_int(item['first']), ip_to_int(item['last'])
+        if item_end < start or item_start > end:
+            updated.append(item)
+            continue
+        if item.get('owner', '') != current:
+            raise ValueError('{0}-{1} is not owned by "{2}"'.format(item['first'], item['last'], current))
+        if item_start < start:
+            updated.append({'first': item['first'], 'last': int_to_ip(start - 1), 'owner': current})
+        updated.append({'first': int_to_ip(max(start, item_start)), 'last': int_to_ip(min(end, item_end)),
+                        'owner': owner})
+        if item_end > end:
+            updated.append({'first': int_to_ip(end + 1), 'last': item['last'], 'owner': current})
+    return normalize(updated)
+
+
+def release(ranges, owner, first=None, last=None):
+    """
+    Free the addresses of owner, only the ones in first..last if given.
+
+    :return: (new list of sub-ranges, list of the freed sub-ranges)
+    """
+    if first is not None:
+        return assign(ranges, first, last or first, '', current=owner), [{'first': first, 'last': last or first}]
+    freed = [{'first': item['first'], 'last': item['last']} for item in ranges if item.get('owner', '') == owner]
+    return normalize(dict(item, owner='') if item.get('owner', '') == owner else item for item in ranges), freed
+
+
+def best_fit(runs, count):
+    """
+    Choose among runs of free addresses: the smallest run holding count
+    addresses so the big runs stay available for big reservations, or when
+    none is big enough, the biggest runs so the reservation is in as few
+    pieces as possible.
+
+    :param runs: list of tuples starting with the first and last address of a
+                 run as integers, extra items are left alone
+    :param count: how many addresses to pick
+    :return: list of (run, how many addresses to take from the start of run),
+             covering fewer than count addresses if the runs are too small
+    """
+    fitting = [run for run in runs if run[1] - run[0] + 1 >= count]
+    if fitting:
+        chosen = [min(fitting, key=lambda run: (run[1] - run[0], run[0]))]
+    else:
+        chosen = sorted(runs, key=lambda run: (run[0] - run[1], run[0]))
+    picked = []
+    remaining = count
+    for run in chosen:
+        if remaining <= 0:
+            break
+        take = min(remaining, run[1] - run[0] + 1)
+        picked.append((run, take))
+        remaining -= take
+    return picked
+
+
+def pick(blocks, count):
+    """
+    Choose free addresses for a reservation among the sub-ranges of several
+    blocks, see best_fit.
+
+    :param blocks: list of block documents, each with a 'ranges' list
+    :param count: how many addresses to pick
+    :return: list of (block index, first, last), empty if there are not
+             count free addresses in the blocks
+    """
+    free = [(ip_to_int(item['first']), ip_to_int(item['last']), index)
+            for index, block in enumerate(blocks) for item in block['ranges'] if item.get('owner', '') == '']
+    picked = best_fit(free, count)
+    if sum(take for run, take in picked) < count:
+        return []
+    return [(run[2], int_to_ip(run[0]), int_to_ip(run[0] + take - 1)) for run, take in picked]
+
+
+def expand(block, owner=None):
+    """
+    Expand the sub-ranges of an address block into address documents.
+
+    :param block: block document with a 'ranges' list
+    :param owner: only expand the sub-ranges of this owner, all of them if None
+    :return: list of {'address', 'owner', 'block', 'tags'} dicts
+    """
+    addresses = []
+    for item in block.get('ranges', []):
+        if owner is not None and item.get('owner', '') != owner:
+            continue
+        for number in range(ip_to_int(item['first']), ip_to_int(item['last']) + 1):
+            addresses.append({'address': int_to_ip(number), 'owner': item.get('owner', ''),
+                              'block': block.get('block'), 'tags': block.get('tags', {})})
+    return addresses
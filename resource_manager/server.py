@@ -3,6 +3,8 @@ from eve import Eve
 from eve.auth import BasicAuth
 from flask_bootstrap import Bootstrap
 from eve_docs import eve_docs
+from bulk import bulk, check_inserted_blocks, check_replaced_block, check_updated_block
+from caching import add_collection_etag
 
 
 class ResourceManagerBasicAuth(BasicAuth):
@@ -17,4 +19,9 @@ class ResourceManagerBasicAuth(BasicAuth):
 app = Eve(settings="./api_config.py", auth=ResourceManagerBasicAuth)
 Bootstrap(app)
 app.register_blueprint(eve_docs, url_prefix='/docs')
+app.register_blueprint(bulk, url_prefix='/bulk')
+app.on_insert += check_inserted_blocks
+app.on_replace += check_replaced_block
+app.on_update += check_updated_block
+app.after_request(add_collection_etag)
 app.run(host='0.0.0.0')
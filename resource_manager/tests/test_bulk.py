@@ -0,0 +1,195 @@
+import copy
+import json
+
+import mock
+from eve import Eve
+from eve.auth import BasicAuth
+from werkzeug.exceptions import UnprocessableEntity
+
+from resource_manager import api_config
+from resource_manager.bulk import apply_changes, bulk, check_block
+
+credentials = {'Authorization': 'Basic YWRtaW46YWRtaW4='}
+
+
+class AdminAuth(BasicAuth):
+    def check_auth(self, username, password, allowed_roles, resource, method):
+        return username == 'admin' and password == 'admin'
+
+
+def get_test_app():
+    settings = dict((name, getattr(api_config, name)) for name in dir(api_config) if name.isupper())
+    settings['DOMAIN'] = copy.deepcopy(api_config.DOMAIN)
+    for domain in settings['DOMAIN'].values():
+        # creating the indexes needs a running MongoDB
+        domain.pop('mongo_indexes')
+    app = Eve(settings=settings, auth=AdminAuth)
+    app.register_blueprint(bulk, url_prefix='/bulk')
+    return app
+
+
+def get_test_client():
+    return get_test_app().test_client()
+
+
+def test_apply_changes():
+    document = {'hostname': 'a-01', 'owner': 'tony', 'tags': {'memory': 1, 'cpucores': 4}}
+    updated = apply_changes(document, {'owner': '', 'tags.memory': 2})
+    assert updated == {'hostname': 'a-01', 'owner': '', 'tags': {'memory': 2, 'cpucores': 4}}
+    assert document['tags']['memory'] == 1
+
+
+def test_update_requires_auth():
+    client = get_test_client()
+    response = client.post('/bulk/machines/update', data=json.dumps({'where': {}, 'set': {'owner': ''}}))
+    assert response.status_code == 401
+
+
+def test_update_validates_changes():
+    client = get_test_client()
+    response = client.post('/bulk/machines/update', headers=credentials,
+                           data=json.dumps({'where': {}, 'set': {'state': 'bogus', '_id': 'x', 'owner.x': 1}}))
+    assert response.status_code == 422
+    assert set(json.loads(response.data)['_issues']) == set(['state', '_id', 'owner.x'])
+
+
+@mock.patch('resource_manager.bulk.get_collection')
+def test_update_reports_lost_races(get_collection):
+    collection = get_collection.return_value
+    originals = [{'_id': 'a', '_etag': '1', 'hostname': 'a-01', 'state': 'in_use'},
+                 {'_id': 'b', '_etag': '2', 'hostname': 'a-02', 'state': 'in_use'}]
+    # a-02 is changed by someone else before the bulk write, only a-01 still has the etag it was read with
+    collection.find.side_effect = [originals, [{'_id': 'a'}]]
+    collection.bulk_write.return_value = mock.Mock(matched_count=1)
+    client = get_test_client()
+    response = client.post('/bulk/machines/update', headers=credentials,
+                           data=json.dumps({'where': {'state': 'in_use'}, 'set': {'state': 'idle'}}))
+    result = json.loads(response.data)
+    assert result['_status'] == 'ERR'
+    assert [(item['hostname'], item['_status']) for item in result['_items']] == [('a-01', 'OK'), ('a-02', 'ERR')]
+    assert result['_items'][1]['_etag'] == '2'
+    writes = collection.bulk_write.call_args[0][0]
+    assert [write._filter for write in writes] == [{'_id': 'a', '_etag': '1'}, {'_id': 'b', '_etag': '2'}]
+    # the race is worked out from which documents carry the new etags
+    query = collection.find.call_args[0][0]
+    assert sorted(query['_id']['$in']) == ['a', 'b']
+    assert len(query['_etag']['$in']) == 2
+
+
+def test_update_rejects_blacklisted_operators():
+    client = get_test_client()
+    response = client.post('/bulk/machines/update', headers=credentials,
+                           data=json.dumps({'where': {'$where': 'true'}, 'set': {'owner': ''}}))
+    assert response.status_code == 400
+
+
+def test_unknown_resource():
+    client = get_test_client()
+    response = client.post('/bulk/nothing/delete', headers=credentials, data=json.dumps({'where': {}}))
+    assert response.status_code == 404
+
+
+def test_claim_requires_count():
+    client = get_test_client()
+    response = client.post('/bulk/machines/claim', headers=credentials,
+                           data=json.dumps({'where': {'state': 'idle'}, 'set': {'state': 'pxe'}}))
+    assert response.status_code == 400
+
+
+def test_claim_rejects_bool_count():
+    client = get_test_client()
+    response = client.post('/bulk/machines/claim', headers=credentials,
+                           data=json.dumps({'where': {'state': 'idle'}, 'count': True, 'set': {'state': 'pxe'}}))
+    assert response.status_code == 400
+
+
+@mock.patch('resource_manager.bulk.get_collection')
+def test_claim_takes_documents_one_at_a_time(get_collection):
+    collection = get_collection.return_value
+    collection.find_one_and_update.side_effect = [{'_id': 'a', 'hostname': 'a-01', '_etag': 'x'},
+                                                  {'_id': 'b', 'hostname': 'a-02', '_etag': 'y'},
+                                                  None]
+    client = get_test_client()
+    response = client.post('/bulk/machines/claim', headers=credentials,
+                           data=json.dumps({'where': {'state': 'idle'}, 'count': 3, 'set': {'state': 'pxe'}}))
+    result = json.loads(response.data)
+    # only two documents were left, the claim is short but successful
+    assert result['_status'] == 'OK'
+    assert [(item['hostname'], item['_etag']) for item in result['_items']] == [('a-01', 'x'), ('a-02', 'y')]
+    queries = [call[0][0] for call in collection.find_one_and_update.call_args_list]
+    assert queries == [{'$and': [{'state': 'idle'}, {'_id': {'$nin': ids}}]} for ids in ([], ['a'], ['a', 'b'])]
+    etags = set()
+    for call in collection.find_one_and_update.call_args_list:
+        changes = call[0][1]['$set']
+        assert changes['state'] == 'pxe'
+        assert '_updated' in changes
+        etags.add(changes['_etag'])
+    # every claim stamps a fresh etag, invalidating the ones other writers hold
+    assert len(etags) == 3
+
+
+def test_reserve_needs_address_ranges():
+    client = get_test_client()
+    response = client.post('/bulk/public-addresses/reserve', headers=credentials,
+                           data=json.dumps({'where': {}, 'count': 1, 'owner': 'job-1'}))
+    assert response.status_code == 400
+
+
+def test_reserve_rejects_bool_count():
+    client = get_test_client()
+    response = client.post('/bulk/public-address-ranges/reserve', headers=credentials,
+                           data=json.dumps({'where': {}, 'count': True, 'owner': 'job-1'}))
+    assert response.status_code == 400
+
+
+def test_reserve_requires_owner():
+    client = get_test_client()
+    response = client.post('/bulk/public-address-ranges/reserve', headers=credentials,
+                           data=json.dumps({'where': {}, 'count': 1, 'owner': ''}))
+    assert response.status_code == 400
+
+
+def test_check_block():
+    app = get_test_app()
+    original = {'block': '10.111.1.0-10.111.1.255', 'ranges': [{'first': '10.111.1.0', 'last': '10.111.1.255'}]}
+    with app.app_context():
+        check_block('public-address-ranges', original)
+        check_block('public-address-ranges', {'ranges': [{'first': '10.111.1.0', 'last': '10.111.1.9'}]}, original)
+        check_block('machines', {'hostname': 'a-01'})
+        try:
+            check_block('public-address-ranges', {'ranges': [{'first': '10.111.1.0', 'last': '10.111.2.9'}]},
+                        original)
+        except UnprocessableEntity:
+            pass
+        else:
+            raise AssertionError("Expected a 422")
+
+
+def test_release_validates_addresses():
+    client = get_test_client()
+    response = client.post('/bulk/public-address-ranges/release', headers=credentials,
+                           data=json.dumps({'where': {}, 'owner': 'job-1', 'first': '10.111.1'}))
+    assert response.status_code == 400
+
+
+@mock.patch('resource_manager.bulk.get_collection')
+def test_partial_reservation_is_rolled_back(get_collection):
+    first = {'_id': 'a', '_etag': '1', 'block': '10.0.0.0-10.0.0.7',
+             'ranges': [{'first': '10.0.0.0', 'last': '10.0.0.7', 'owner': ''}]}
+    second = {'_id': 'b', '_etag': '1', 'block': '10.0.1.0-10.0.1.7',
+              'ranges': [{'first': '10.0.1.0', 'last': '10.0.1.7', 'owner': ''}]}
+    collection = get_collection.return_value
+    collection.find.side_effect = [[first, second]] + [[second]] * 4
+    # every write of the second block loses a race
+    collection.update_one.side_effect = lambda query, update: mock.Mock(matched_count=int(query['_id'] == 'a'))
+    collection.find_one.return_value = dict(first, ranges=[{'first': '10.0.0.0', 'last': '10.0.0.7',
+                                                            'owner': 'job-1'}])
+    client = get_test_client()
+    response = client.post('/bulk/public-address-ranges/reserve', headers=credentials,
+                           data=json.dumps({'where': {}, 'count': 12, 'owner': 'job-1'}))
+    result = json.loads(response.data)
+    assert result['_status'] == 'ERR'
+    assert result['_items'] == []
+    query, update = collection.update_one.call_args[0]
+    assert query['_id'] == 'a'
+    assert update['$set']['ranges'] == [{'first': '10.0.0.0', 'last': '10.0.0.7', 'owner': ''}]
@@ -0,0 +1,31 @@
+from flask import Flask
+
+from resource_manager.caching import add_collection_etag
+
+
+def get_test_client():
+    app = Flask(__name__)
+    app.after_request(add_collection_etag)
+
+    @app.route('/machines')
+    def machines():
+        return '{"_items": []}'
+
+    return app.test_client()
+
+
+def test_collection_etag():
+    client = get_test_client()
+    response = client.get('/machines')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    response = client.get('/machines', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == ''
+
+
+def test_collection_changed():
+    client = get_test_client()
+    response = client.get('/machines', headers={'If-None-Match': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == '{"_items": []}'
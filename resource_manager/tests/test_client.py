@@ -1,8 +1,11 @@
 import json
 import httpretty
+import mock
 import urllib
 
-from resource_manager.client import ResourceManagerClient
+from resource_manager.api_config import PAGINATION_LIMIT
+from resource_manager.client import ResourceManagerClient, RequestFailureException
+from resource_manager.client import ConcurrentResourceManagerClient, ConcurrentRequestFailureException, ResourceMirror
 
 
 def test_init():
@@ -85,3 +88,268 @@ def test_get_all_resources():
     response_body = "{\"_items\":[]}"
     httpretty.register_uri(httpretty.GET, url, body=response_body)
     assert isinstance(client.get_all_resources(), list)
+
+
+@httpretty.activate
+def test_find_resources_filters_on_server():
+    client = ResourceManagerClient()
+    response_body = "{\"_items\":[{\"hostname\": \"a-01\", \"state\": \"idle\"}]}"
+    httpretty.register_uri(httpretty.GET, client.endpoint, body=response_body)
+    assert client.find_resources('state', 'idle') == json.loads(response_body)["_items"]
+    where = json.loads(httpretty.last_request().querystring['where'][0])
+    assert where == {'state': 'idle'}
+
+
+@httpretty.activate
+def test_find_resources_in():
+    client = ResourceManagerClient()
+    httpretty.register_uri(httpretty.GET, client.endpoint, body="{\"_items\":[]}")
+    client.find_resources('hostname', ['a-01', 'a-02'])
+    where = json.loads(httpretty.last_request().querystring['where'][0])
+    assert where == {'hostname': {'$in': ['a-01', 'a-02']}}
+
+
+@httpretty.activate
+def test_query_resources_failure():
+    client = ResourceManagerClient()
+    httpretty.register_uri(httpretty.GET, client.endpoint, status=400, body="{}")
+    try:
+        client.query_resources({'state': {'$where': 'true'}})
+    except RequestFailureException:
+        pass
+    else:
+        raise AssertionError("Expected RequestFailureException")
+
+
+def test_session_pool():
+    client = ResourceManagerClient(pool_size=4, retries=2)
+    adapter = client.session.get_adapter(client.endpoint)
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    assert client.timeout == (3.05, 30)
+
+
+@httpretty.activate
+def test_get_retries_on_unavailable():
+    client = ResourceManagerClient(backoff_factor=0)
+    url = client.endpoint + "/test_machine"
+    httpretty.register_uri(httpretty.GET, url, responses=[httpretty.Response(body="{}", status=503),
+                                                          httpretty.Response(body='{"_id": "my_id"}', status=200)])
+    assert client.get_resource('test_machine') == {"_id": "my_id"}
+
+
+@httpretty.activate
+def test_update_leaves_default_headers_alone():
+    client = ResourceManagerClient()
+    httpretty.register_uri(httpretty.GET, client.endpoint + "/resource", body='{"_id": "my_id", "_etag":"1234"}')
+    httpretty.register_uri(httpretty.PATCH, client.endpoint + "/my_id", body='{"_id": "my_id"}')
+    client.update_resource("{\"hostname\":\"resource\"}")
+    assert httpretty.last_request().headers['If-Match'] == '1234'
+    assert client.headers == {'content-type': 'application/json'}
+
+
+@httpretty.activate
+def test_update_uses_cached_etag():
+    client = ResourceManagerClient()
+    resource = "{\"hostname\":\"resource\"}"
+    httpretty.register_uri(httpretty.GET, client.endpoint + "/resource", body='{"_id": "my_id", "_etag":"1"}')
+    httpretty.register_uri(httpretty.PATCH, client.endpoint + "/my_id", body='{"_id": "my_id", "_etag":"2"}')
+    client.update_resource(resource)
+    client.update_resource(resource)
+    methods = [request.method for request in httpretty.latest_requests()]
+    assert methods == ['GET', 'PATCH', 'PATCH']
+    assert httpretty.last_request().headers['If-Match'] == '2'
+
+
+@httpretty.activate
+def test_update_refreshes_stale_etag():
+    client = ResourceManagerClient()
+    httpretty.register_uri(httpretty.GET, client.endpoint, body='{"_items":[{"hostname": "resource", "_id": "my_id", '
+                                                                '"_etag":"stale"}]}')
+    client.get_all_resources()
+    httpretty.register_uri(httpretty.GET, client.endpoint + "/resource", body='{"_id": "my_id", "_etag":"fresh"}')
+    httpretty.register_uri(httpretty.PATCH, client.endpoint + "/my_id",
+                           responses=[httpretty.Response(body='{}', status=412),
+                                      httpretty.Response(body='{"_id": "my_id", "_etag":"newer"}', status=200)])
+    client.update_resource("{\"hostname\":\"resource\"}")
+    assert httpretty.last_request().headers['If-Match'] == 'fresh'
+    assert client._etags['resource'] == ('my_id', 'newer')
+
+
+@httpretty.activate
+def test_create_resources():
+    client = ResourceManagerClient()
+    response_body = '{"_status": "OK", "_items": [{"_id": "1", "_etag": "a"}, {"_id": "2", "_etag": "b"}]}'
+    httpretty.register_uri(httpretty.POST, client.endpoint, status=201, body=response_body)
+    client.create_resources([{"hostname": "a-01"}, {"hostname": "a-02"}])
+    assert json.loads(httpretty.last_request().body) == [{"hostname": "a-01"}, {"hostname": "a-02"}]
+    assert client._etags == {"a-01": ("1", "a"), "a-02": ("2", "b")}
+
+
+@httpretty.activate
+def test_update_resources():
+    client = ResourceManagerClient()
+    response_body = '{"_status": "OK", "_items": [{"_id": "1", "_etag": "a", "hostname": "a-01", "_status": "OK"}]}'
+    httpretty.register_uri(httpretty.POST, client.bulk_endpoint + "/update", body=response_body)
+    results = client.update_resources({'job_id': 'job-1'}, {'state': 'idle'})
+    assert results == json.loads(response_body)['_items']
+    assert json.loads(httpretty.last_request().body) == {'where': {'job_id': 'job-1'}, 'set': {'state': 'idle'}}
+    assert client._etags == {"a-01": ("1", "a")}
+
+
+@httpretty.activate
+def test_delete_resources():
+    client = ResourceManagerClient()
+    client._etags['a-01'] = ('1', 'a')
+    response_body = '{"_status": "OK", "_items": [{"_id": "1", "hostname": "a-01", "_status": "OK"}]}'
+    httpretty.register_uri(httpretty.POST, client.bulk_endpoint + "/delete", body=response_body)
+    client.delete_resources({'hostname': 'a-01'})
+    assert client._etags == {}
+
+
+@httpretty.activate
+def test_claim_resources():
+    client = ResourceManagerClient()
+    response_body = '{"_status": "OK", "_items": [{"_id": "1", "_etag": "a", "hostname": "a-01", "_status": "OK"}]}'
+    httpretty.register_uri(httpretty.POST, client.bulk_endpoint + "/claim", body=response_body)
+    claimed = client.claim_resources({'state': 'idle'}, 2, {'state': 'pxe'})
+    assert [item['hostname'] for item in claimed] == ['a-01']
+    assert json.loads(httpretty.last_request().body) == {'where': {'state': 'idle'}, 'count': 2,
+                                                         'set': {'state': 'pxe'}}
+
+
+@httpretty.activate
+def test_iter_resources_pages():
+    client = ResourceManagerClient(page_size=2)
+    first = '{"_items": [{"_id": "1", "hostname": "a-01"}, {"_id": "2", "hostname": "a-02"}]}'
+    second = '{"_items": [{"_id": "3", "hostname": "a-03"}]}'
+    responses = [httpretty.Response(body=first), httpretty.Response(body=second)]
+    httpretty.register_uri(httpretty.GET, client.endpoint, responses=responses)
+    hostnames = [item['hostname'] for item in client.iter_resources(where={'state': 'idle'}, fields=['state'])]
+    assert hostnames == ['a-01', 'a-02', 'a-03']
+    querystring = httpretty.last_request().querystring
+    assert querystring['page'] == ['1']
+    assert querystring['sort'] == ['[("_id", 1)]']
+    assert querystring['max_results'] == ['2']
+    assert json.loads(querystring['where'][0]) == {'$and': [{'state': 'idle'}, {'_id': {'$gt': '2'}}]}
+    assert json.loads(querystring['projection'][0]) == {'hostname': 1, 'state': 1}
+
+
+@httpretty.activate
+def test_iter_resources_follows_server_page_limit():
+    client = ResourceManagerClient(page_size=5000)
+    first = '{"_items": [{"_id": "1", "hostname": "a-01"}, {"_id": "2", "hostname": "a-02"}], ' \
+            '"_meta": {"max_results": 2, "total": 3}}'
+    second = '{"_items": [{"_id": "3", "hostname": "a-03"}], "_meta": {"max_results": 2, "total": 1}}'
+    responses = [httpretty.Response(body=first), httpretty.Response(body=second)]
+    httpretty.register_uri(httpretty.GET, client.endpoint, responses=responses)
+    assert [item['hostname'] for item in client.iter_resources()] == ['a-01', 'a-02', 'a-03']
+
+
+def test_page_size_within_server_limit():
+    assert ResourceManagerClient().page_size <= PAGINATION_LIMIT
+
+
+@httpretty.activate
+def test_concurrent_map():
+    client = ConcurrentResourceManagerClient(concurrency=2)
+    for name in ['a-01', 'a-02', 'a-03']:
+        httpretty.register_uri(httpretty.GET, client.endpoint + "/" + name,
+                               body='{"_id": "%s", "_etag": "1", "hostname": "%s"}' % (name, name))
+    results = client.map('get_resource', ['a-01', 'a-02', 'a-03'])
+    client.close()
+    assert [result['_id'] for result in results] == ['a-01', 'a-02', 'a-03']
+
+
+@httpretty.activate
+def test_concurrent_map_failures():
+    client = ConcurrentResourceManagerClient(concurrency=2)
+    httpretty.register_uri(httpretty.POST, client.endpoint, responses=[httpretty.Response(body='{}', status=201),
+                                                                       httpretty.Response(body='{}', status=422)])
+    try:
+        client.map('create_resource', ['{"hostname": "a-01"}', '{"hostname": "a-02"}'])
+    except ConcurrentRequestFailureException as e:
+        assert len(e.results) == 2
+        assert len(e.failures) == 1
+        assert isinstance(e.failures[0][1], RequestFailureException)
+    else:
+        raise AssertionError("Expected ConcurrentRequestFailureException")
+    finally:
+        client.close()
+
+
+@httpretty.activate
+def test_listing_cache():
+    client = ResourceManagerClient(cache_ttl=30)
+    httpretty.register_uri(httpretty.GET, client.endpoint, body='{"_items": [{"hostname": "a-01"}]}',
+                           adding_headers={'ETag': '"v1"'})
+    with mock.patch('resource_manager.client.time.time', return_value=100):
+        assert client.find_resources('state', 'idle') == [{"hostname": "a-01"}]
+        client.find_resources('state', 'idle')[0].pop('hostname')
+        assert client.find_resources('state', 'idle') == [{"hostname": "a-01"}]
+    assert len(httpretty.latest_requests()) == 1
+
+    httpretty.register_uri(httpretty.GET, client.endpoint, status=304, body='')
+    with mock.patch('resource_manager.client.time.time', return_value=200):
+        assert client.find_resources('state', 'idle') == [{"hostname": "a-01"}]
+    assert httpretty.last_request().headers['If-None-Match'] == '"v1"'
+
+
+@httpretty.activate
+def test_listing_cache_invalidated_by_writes():
+    client = ResourceManagerClient(cache_ttl=30)
+    httpretty.register_uri(httpretty.GET, client.endpoint, body='{"_items": []}')
+    httpretty.register_uri(httpretty.POST, client.endpoint, status=201)
+    client.get_all_resources()
+    client.create_resource('{"hostname": "a-01"}')
+    client.get_all_resources()
+    methods = [request.method for request in httpretty.latest_requests()]
+    assert methods == ['GET', 'POST', 'GET']
+
+
+@httpretty.activate
+def test_mirror_sync():
+    client = ResourceManagerClient()
+    mirror = ResourceMirror(client)
+    old, new = 'Mon, 03 Apr 2017 10:00:00 GMT', 'Tue, 04 Apr 2017 10:00:00 GMT'
+    full = {"_items": [{"hostname": "a-01", "state": "idle", "_updated": old},
+                       {"hostname": "a-02", "state": "idle", "_updated": new}], "_meta": {"total": 2}}
+    httpretty.register_uri(httpretty.GET, client.endpoint, body=json.dumps(full))
+    assert mirror.sync() == (['a-01', 'a-02'], [])
+    assert mirror.watermark == new
+
+    delta = {"_items": [{"hostname": "a-02", "state": "pxe", "_updated": new}], "_meta": {"total": 1}}
+    keys = {"_items": [{"hostname": "a-02"}], "_meta": {"total": 1}}
+    httpretty.register_uri(httpretty.GET, client.endpoint,
+                           responses=[httpretty.Response(body=json.dumps(delta)),
+                                      httpretty.Response(body=json.dumps(delta)),
+                                      httpretty.Response(body=json.dumps(keys))])
+    assert mirror.sync() == (['a-02'], ['a-01'])
+    assert mirror.resources == {"a-02": {"hostname": "a-02", "state": "pxe", "_updated": new}}
+    where = [json.loads(request.querystring['where'][0]) for request in httpretty.latest_requests()
+             if 'where' in request.querystring]
+    assert where == [{'_updated': {'$gte': new}}]
+
+
+@httpretty.activate
+def test_reserve_addresses_expands_ranges():
+    client = ResourceManagerClient('public-address-ranges')
+    response_body = json.dumps({'_status': 'OK', '_items': [
+        {'_id': '1', '_etag': 'a', 'block': '10.111.1.0-10.111.1.255', 'first': '10.111.1.20', 'last': '10.111.1.22',
+         'owner': 'job-1', '_status': 'OK'}]})
+    httpretty.register_uri(httpretty.POST, client.bulk_endpoint + "/reserve", body=response_body)
+    addresses = client.reserve_addresses(3, 'job-1', where={'tags.subnet': 'a'})
+    assert addresses == ['10.111.1.20', '10.111.1.21', '10.111.1.22']
+    assert json.loads(httpretty.last_request().body) == {'where': {'tags.subnet': 'a'}, 'count': 3, 'owner': 'job-1'}
+
+
+@httpretty.activate
+def test_iter_addresses():
+    client = ResourceManagerClient('public-address-ranges')
+    response_body = json.dumps({'_items': [{'_id': '1', '_etag': 'a', 'block': '10.111.1.0-10.111.1.255', 'ranges': [
+        {'first': '10.111.1.0', 'last': '10.111.1.1', 'owner': ''},
+        {'first': '10.111.1.2', 'last': '10.111.1.255', 'owner': 'job-1'}]}], '_links': {}})
+    httpretty.register_uri(httpretty.GET, client.endpoint, body=response_body)
+    addresses = list(client.iter_addresses(owner=''))
+    assert [address['address'] for address in addresses] == ['10.111.1.0', '10.111.1.1']
+    assert json.loads(httpretty.last_request().querystring['where'][0]) == {'$and': [{}, {'ranges.owner': ''}]}
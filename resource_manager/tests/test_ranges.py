@@ -0,0 +1,66 @@
+from resource_manager.ranges import assign, expand, normalize, pick, release, validate
+
+block = {'block': '10.111.1.0-10.111.1.255', 'tags': {'subnet': 'a'},
+         'ranges': [{'first': '10.111.1.0', 'last': '10.111.1.9', 'owner': ''},
+                    {'first': '10.111.1.10', 'last': '10.111.1.19', 'owner': 'job-1'},
+                    {'first': '10.111.1.20', 'last': '10.111.1.23', 'owner': ''}]}
+
+
+def test_normalize_merges_neighbours():
+    ranges = normalize([{'first': '10.111.1.5', 'last': '10.111.1.9', 'owner': ''},
+                        {'first': '10.111.1.0', 'last': '10.111.1.4'},
+                        {'first': '10.111.1.10', 'last': '10.111.1.10', 'owner': 'job-1'}])
+    assert ranges == [{'first': '10.111.1.0', 'last': '10.111.1.9', 'owner': ''},
+                      {'first': '10.111.1.10', 'last': '10.111.1.10', 'owner': 'job-1'}]
+
+
+def test_assign_splits():
+    ranges = assign(block['ranges'], '10.111.1.2', '10.111.1.3', 'job-2')
+    assert [(item['first'], item['owner']) for item in ranges] == \
+        [('10.111.1.0', ''), ('10.111.1.2', 'job-2'), ('10.111.1.4', ''), ('10.111.1.10', 'job-1'),
+         ('10.111.1.20', '')]
+    try:
+        assign(block['ranges'], '10.111.1.8', '10.111.1.11', 'job-2')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError")
+
+
+def test_release_merges_back():
+    ranges, freed = release(block['ranges'], 'job-1')
+    assert ranges == [{'first': '10.111.1.0', 'last': '10.111.1.23', 'owner': ''}]
+    assert freed == [{'first': '10.111.1.10', 'last': '10.111.1.19'}]
+    ranges, _ = release(block['ranges'], 'job-1', '10.111.1.19')
+    assert ranges[-1] == {'first': '10.111.1.19', 'last': '10.111.1.23', 'owner': ''}
+
+
+def test_pick_best_fit():
+    assert pick([block], 3) == [(0, '10.111.1.20', '10.111.1.22')]
+    assert pick([block], 12) == [(0, '10.111.1.0', '10.111.1.9'), (0, '10.111.1.20', '10.111.1.21')]
+    assert pick([block], 15) == []
+
+
+def test_expand():
+    addresses = expand(block, owner='job-1')
+    assert [address['address'] for address in addresses] == ['10.111.1.%d' % i for i in range(10, 20)]
+    assert addresses[0]['tags'] == {'subnet': 'a'}
+    assert len(expand(block)) == 24
+
+
+def test_validate():
+    validate(block['block'], block['ranges'])
+    validate('10.111.1.7', [{'first': '10.111.1.7', 'last': '10.111.1.7'}])
+    for bad_block, ranges in [('10.111.1', []),
+                              ('10.111.1.255-10.111.1.0', []),
+                              (block['block'], [{'first': '10.111.1.9', 'last': '10.111.1.0'}]),
+                              (block['block'], [{'first': '10.111.1.250', 'last': '10.111.2.5'}]),
+                              (block['block'], [{'first': 'nonsense', 'last': '10.111.1.5'}]),
+                              (block['block'], [{'first': '10.111.1.0', 'last': '10.111.1.9'},
+                                                {'first': '10.111.1.9', 'last': '10.111.1.12'}])]:
+        try:
+            validate(bad_block, ranges)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected ValueError for {0} {1}".format(bad_block, ranges))
@@ -3,7 +3,7 @@ from resource_manager.api_config import PAGINATION, RESOURCE_METHODS, ITEM_METHO
 
 
 def test_load():
-    assert PAGINATION is False
+    assert PAGINATION is True
     assert RESOURCE_METHODS == ['GET', 'POST', 'DELETE']
     assert ['GET', 'PATCH', 'PUT', 'DELETE'] == ITEM_METHODS
     assert lookup_url == 'regex("[\.\w-]+")'
@@ -31,7 +31,7 @@ def test_machine_unique():
 
 def test_machine_states():
     schema = ResourceSchema().machine_schema
-    assert schema["state"]['allowed'] == ["pxe", "pxe_failed", "idle", "in_use", "needs_repair"]
+    assert schema["state"]['allowed'] == ["pxe", "pxe_failed", "idle", "in_use", "needs_repair", "ready"]
 
 
 def test_address_keys():
@@ -64,3 +64,21 @@ def test_domains():
     domain_check(schema.machines, "machine")
     domain_check(schema.private_addresses, "private-address")
     domain_check(schema.public_addresses, "public-address")
+
+
+def test_indexes():
+    schema = ResourceSchema()
+    assert schema.machines['mongo_indexes']['state_memory'] == [('state', 1), ('tags.memory', 1)]
+    assert schema.machines['mongo_indexes']['owner_job_id'] == [('owner', 1), ('job_id', 1)]
+    assert schema.machines['mongo_indexes']['state_distro'] == [('state', 1), ('distro', 1)]
+    for domain in (schema.public_addresses, schema.private_addresses):
+        assert domain['mongo_indexes']['owner'] == [('owner', 1)]
+
+
+def test_address_ranges():
+    schema = ResourceSchema()
+    assert schema.address_range_schema['block']['unique']
+    assert 'owner' in schema.address_range_schema['ranges']['schema']['schema']
+    domain_check(schema.public_address_ranges, "public-address-range")
+    domain_check(schema.private_address_ranges, "private-address-range")
+    assert schema.public_address_ranges['mongo_indexes']['owner'] == [('ranges.owner', 1)]
@@ -8,7 +8,7 @@
 import json
 import re
 
-from resource_manager.client import ResourceManagerClient
+from resource_manager.client import ConcurrentResourceManagerClient
 
 # newhosts is a json formatted file of hosts and memory collected from nephoria
 # newhosts looks like this (for future reference):
@@ -52,11 +52,13 @@ if __name__ == "__main__":
     with open(newhosts, "r") as file:
         collected = json.loads(file.read())
 
-    # client = ResourceManagerClient(endpoint="http://10.111.4.100:5000")  #  PRODUCTION
-    client = ResourceManagerClient(endpoint="http://127.0.0.1:5000")  # USE "http://10.111.4.100:5000" for production
+    # client = ConcurrentResourceManagerClient(endpoint="http://10.111.4.100:5000")  #  PRODUCTION
+    # USE "http://10.111.4.100:5000" for production
+    client = ConcurrentResourceManagerClient(endpoint="http://127.0.0.1:5000", concurrency=20)
     ourlist = client.get_all_resources()
-    for item in ourlist:
-        machine = client.get_resource(item['hostname'])  # PRODUCTION
+    machines = client.map('get_resource', [item['hostname'] for item in ourlist])  # PRODUCTION
+    updates = []
+    for item, machine in zip(ourlist, machines):
         for mtype in memtable:
             match = re.search(memtable[mtype]['regex'], item['hostname'])
             if match:
@@ -86,7 +88,10 @@ if __name__ == "__main__":
         machine.pop('_etag')  # PRODUCTION
         machine.pop('_created')  # PRODUCTION
         machine.pop('_links')  # PRODUCTION
-        print "Performing client.put_resource(json.dumps({}))".format(item['hostname'])
+        print "Queueing client.put_resource(json.dumps({}))".format(item['hostname'])
+        updates.append(json.dumps(machine))
 
-        # WARNING!! - DON'T ENABLE THIS UNLESS YOU WANT TO UPDATE YOUR DB!!!!
-        # client.put_resource(json.dumps(machine))  # PRODUCTION
+    print "Performing {} put_resource calls".format(len(updates))
+    # WARNING!! - DON'T ENABLE THIS UNLESS YOU WANT TO UPDATE YOUR DB!!!!
+    # client.map('put_resource', updates)  # PRODUCTION
+    client.close()